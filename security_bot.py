@@ -11,13 +11,23 @@ Características:
 """
 
 import os
+import asyncio
+import collections
+import heapq
+import html
 import json
 import logging
+import multiprocessing
+import queue
+import signal
 import sqlite3
 import subprocess
+import tempfile
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import shared_memory
 from pathlib import Path
 from typing import List, Optional
 
@@ -29,7 +39,7 @@ except ImportError:
     OPENCV_AVAILABLE = False
     logging.warning("OpenCV no disponible. Detección de movimiento deshabilitada.")
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -59,20 +69,197 @@ AUTHORIZED_USERS = CONFIG['telegram']['authorized_users']
 COMMANDS_WHITELIST = CONFIG['commands_whitelist']
 DB_PATH = CONFIG['paths']['db']
 
-# Variables globales para detección de movimiento
-motion_detection_active = False
-motion_thread = None
-last_motion_time = 0
-MOTION_COOLDOWN = 30  # segundos entre alertas
+# Aplicación de Telegram en ejecución y su event loop (se asignan en main/post_init)
+application = None
+bot_loop = None
+
+# Detección de movimiento
+SECURITY_CONFIG = CONFIG.get('security', {})
+# Tras una alerta, los movimientos siguientes se agrupan en un único álbum con las
+# mejores fotos (por área del contorno o por nitidez). La ráfaga se cierra tras
+# alert_quiet segundos sin movimiento o, como mucho, alert_window segundos después de abrirse
+MOTION_ALERT_WINDOW = SECURITY_CONFIG.get('alert_window', 30)
+MOTION_ALERT_QUIET = SECURITY_CONFIG.get('alert_quiet', 10)
+MOTION_DIGEST_PHOTOS = min(10, SECURITY_CONFIG.get('digest_photos', 4))  # un álbum admite hasta 10
+MOTION_DIGEST_RANK = SECURITY_CONFIG.get('digest_rank', 'area')  # "area" o "sharpness"
+# Área mínima (píxeles a resolución completa) de un contorno para considerarlo movimiento
+MOTION_MIN_AREA = SECURITY_CONFIG.get('min_area', 5000)
+# Ancho al que se analiza cada frame en gris; el alto sigue la proporción de la cámara
+# (0 = resolución completa)
+MOTION_ANALYSIS_WIDTH = SECURITY_CONFIG.get('analysis_width', 160)
+# Motor de detección: "diff" (diferencia entre frames), "average" (fondo por media móvil) o "mog2"
+MOTION_ENGINE = SECURITY_CONFIG.get('motion_engine', 'diff')
+MOTION_DIFF_THRESHOLD = SECURITY_CONFIG.get('diff_threshold', 20)  # diferencia de gris mínima por píxel
+# Antigüedad mínima del frame de referencia del motor "diff": a fps altos dos frames
+# consecutivos apenas difieren y un movimiento lento no superaría la vía rápida
+MOTION_DIFF_MIN_INTERVAL = 0.1
+MOTION_BACKGROUND_ALPHA = SECURITY_CONFIG.get('background_alpha', 0.05)  # velocidad de aprendizaje del fondo
+MOTION_MOG2_HISTORY = SECURITY_CONFIG.get('mog2_history', 500)
+MOTION_MOG2_VAR_THRESHOLD = SECURITY_CONFIG.get('mog2_var_threshold', 16)
+# Vía rápida: fracción mínima de píxeles cambiados para buscar contornos
+MOTION_MIN_CHANGED_RATIO = SECURITY_CONFIG.get('min_changed_ratio', 0.005)
+# Rejilla opcional [columnas, filas]: decide por la celda con más cambios
+MOTION_GRID = SECURITY_CONFIG.get('motion_grid')
+MOTION_MIN_CELL_RATIO = SECURITY_CONFIG.get('min_cell_ratio', 0.05)
+# Zonas vigiladas: [{"name", "polygon": [[x, y], ...] en fracciones del frame (0-1), "min_area"}]
+MOTION_ZONES = SECURITY_CONFIG.get('zones', [])
+# Frecuencia adaptativa: pocos fps con la escena quieta y el máximo durante la actividad
+MOTION_IDLE_FPS = SECURITY_CONFIG.get('idle_fps', 2)
+MOTION_ACTIVE_FPS = SECURITY_CONFIG.get('active_fps', 0)  # 0 = máximo de la cámara
+MOTION_ACTIVE_WINDOW = SECURITY_CONFIG.get('active_window', 10)  # segundos a fps máximos tras un cambio
+# Clips de vídeo con los segundos anteriores y posteriores al movimiento
+CLIP_CONFIG = SECURITY_CONFIG.get('clip', {})
+CLIP_ENABLED = CLIP_CONFIG.get('enabled', False)
+CLIP_PRE_SECONDS = CLIP_CONFIG.get('pre_seconds', 3)
+CLIP_POST_SECONDS = CLIP_CONFIG.get('post_seconds', 5)
+CLIP_FPS = CLIP_CONFIG.get('fps', 5)
+CLIP_WIDTH = CLIP_CONFIG.get('width', 320)
+CLIP_CODEC = CLIP_CONFIG.get('codec', 'mp4v')
+# Dónde se analizan los frames: "thread" (hilo del bot) o "process" (un proceso por cámara,
+# alimentado por memoria compartida, para usar todos los núcleos sin competir por el GIL)
+MOTION_ANALYSIS_MODE = SECURITY_CONFIG.get('analysis_mode', 'thread')
+MOTION_PROCESS_TIMEOUT = 5  # segundos esperando el resultado de un proceso de análisis
+MOTION_PROCESS_START_TIMEOUT = 60  # segundos para arrancar (importar OpenCV en una Pi Zero es lento)
+MOTION_FRAME_QUEUE_SIZE = 2  # frames pendientes entre captura y análisis
+MOTION_ALERT_QUEUE_SIZE = 5  # avisos pendientes de enviar
+MOTION_DRAIN_TIMEOUT = 30  # segundos para enviar los avisos pendientes al detener la detección
+ALERT_CONCURRENCY = 5  # envíos simultáneos de alertas a usuarios
+
+# Ejecución de comandos
+COMMAND_TIMEOUT = 30  # segundos
+MAX_CONCURRENT_COMMANDS = 4  # comandos ejecutándose a la vez en total
+MAX_COMMANDS_PER_USER = 2  # comandos ejecutándose a la vez por usuario
+OUTPUT_MESSAGE_LIMIT = 3900  # bytes de salida que se guardan en memoria para el mensaje
+TELEGRAM_MESSAGE_LIMIT = 4096  # caracteres máximos de un mensaje de Telegram
+OUTPUT_EDIT_INTERVAL = 1.0  # segundos mínimos entre ediciones del mensaje
+OUTPUT_CHUNK_SIZE = 4096  # bytes leídos de stdout por iteración
+
+# Reconocimiento de voz
+VOICE_CONFIG = CONFIG.get('voice', {})
+VOSK_MODEL_PATH = VOICE_CONFIG.get('model_path', 'model')
+VOSK_PRELOAD = VOICE_CONFIG.get('preload_model', False)  # cargar el modelo al arrancar
+VOICE_SAMPLE_RATE = 16000
+VOICE_CHUNK_BYTES = 8000  # 0.25 s de audio PCM de 16 bits
+
+# Planificador de tareas
+SCHEDULER_MAX_SLEEP = 300  # segundos; revisar el reloj por si NTP lo ajusta
+
+# Registro de eventos por lotes
+EVENT_QUEUE_SIZE = 1000  # eventos pendientes como máximo en memoria
+EVENT_BATCH_SIZE = 100  # eventos por transacción
+EVENT_FLUSH_INTERVAL = 1.0  # segundos máximos antes de escribir un lote
+
+# Historial de eventos
+EVENTS_PAGE_SIZE = 10
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 31  # un mensaje de Telegram admite ~4096 caracteres
+SEARCH_RESULTS = 10
+STATS_EVENT_TYPES = [
+    ("motion_detected", "🎥", "Movimiento"),
+    ("blocked_command", "⛔", "Comandos bloqueados"),
+    ("unauthorized_access", "🚫", "Accesos no autorizados"),
+]
+
+# Retención de eventos y archivos multimedia (0 = sin límite)
+RETENTION_CONFIG = CONFIG.get('retention', {})
+EVENTS_MAX_AGE_DAYS = RETENTION_CONFIG.get('events_max_age_days', 90)
+MEDIA_MAX_AGE_DAYS = RETENTION_CONFIG.get('media_max_age_days', 30)
+MEDIA_MAX_MB = RETENTION_CONFIG.get('media_max_mb', 1024)
+RETENTION_INTERVAL_HOURS = RETENTION_CONFIG.get('interval_hours', 6)
+RETENTION_BATCH_SIZE = 500  # filas borradas por transacción
+# VACUUM completo (una sola vez) para activar auto_vacuum incremental en una BD creada sin él.
+# Bloquea la BD mientras dura y necesita libre el doble de su tamaño, por eso es opcional
+RETENTION_FULL_VACUUM = RETENTION_CONFIG.get('full_vacuum', False)
+MEDIA_DIR = Path('media')
+
+# Cámaras: lista security.cameras o, si no existe, una sola con security.camera_device.
+# Cada cámara puede redefinir los umbrales de detección (ver MotionPipeline)
+CAMERA_DEVICE = SECURITY_CONFIG.get('camera_device', 0)
+CAMERAS = SECURITY_CONFIG.get('cameras') or [{'name': 'principal', 'device': CAMERA_DEVICE}]
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+CAMERA_BUFFER_SIZE = 4  # frames en el buffer circular
+CAMERA_FRAME_TIMEOUT = 5  # segundos esperando un frame antes de fallar
+# Segundos sin lecturas tras los que se libera la cámara (0 = nunca). Mantenerla abierta
+# evita que cada /photo suelto pague el arranque del dispositivo
+CAMERA_IDLE_RELEASE = SECURITY_CONFIG.get('camera_idle_release', 0)
+# Sin detección activa la cámara solo decodifica a idle_fps
+CAMERA_IDLE_INTERVAL = 1 / MOTION_IDLE_FPS if MOTION_IDLE_FPS else 0.0
+
+# ===== BASE DE DATOS =====
+
+class Database:
+    """Conexión SQLite persistente compartida por todo el bot.
+
+    Todas las operaciones se ejecutan en un único hilo dedicado con la misma
+    conexión (WAL, synchronous=NORMAL), así los handlers no bloquean el event
+    loop y el hilo de movimiento no compite por los locks del archivo. El
+    módulo sqlite3 guarda las sentencias ya preparadas por conexión, así que
+    reutilizar la conexión evita recompilarlas en cada llamada.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=128)
+        # Solo surte efecto en una BD nueva (antes de crear tablas); ver compact_database
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _call(self, fn, *args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return fn(self._conn, *args)
+
+    def submit(self, fn, *args):
+        """Encolar fn(conn, *args) en el hilo de la BD. Devuelve un Future"""
+        return self._executor.submit(self._call, fn, *args)
+
+    def call(self, fn, *args):
+        """Ejecutar fn(conn, *args) y esperar el resultado (para hilos y arranque)"""
+        return self.submit(fn, *args).result()
+
+    async def run(self, fn, *args):
+        """Ejecutar fn(conn, *args) sin bloquear el event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    async def execute(self, sql: str, params=()):
+        """Ejecutar una escritura en su propia transacción. Devuelve el cursor"""
+        def write(conn):
+            with conn:
+                return conn.execute(sql, params)
+        return await self.run(write)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        def close_conn(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            self.call(close_conn)
+        self._executor.shutdown(wait=True)
+
+db = Database(DB_PATH)
 
-# Base de datos
 def init_db():
-    """Inicializar base de datos SQLite"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+    """Inicializar base de datos SQLite aplicando las migraciones pendientes"""
+    db.call(apply_migrations)
+
+# Migraciones del esquema. La versión aplicada se guarda en PRAGMA user_version;
+# los cambios nuevos se añaden al final de MIGRATIONS, nunca se editan los existentes.
+
+def migrate_initial_tables(conn):
+    """Tablas originales (IF NOT EXISTS para bases de datos anteriores a las migraciones)"""
     # Tabla de tareas programadas
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS scheduled_tasks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -83,9 +270,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
     # Tabla de eventos de seguridad
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS security_events (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             event_type TEXT,
@@ -94,24 +281,239 @@ def init_db():
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-def log_security_event(event_type: str, description: str, photo_path: str = None):
-    """Registrar evento de seguridad en la BD"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO security_events (event_type, description, photo_path) VALUES (?, ?, ?)",
-            (event_type, description, photo_path)
-        )
-        conn.commit()
-        conn.close()
+def migrate_task_last_run(conn):
+    """Última ejecución de cada tarea (evita repetirla tras un reinicio)"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(scheduled_tasks)")]
+    if 'last_run' not in columns:
+        conn.execute("ALTER TABLE scheduled_tasks ADD COLUMN last_run TIMESTAMP")
+
+def migrate_indexes(conn):
+    """Índices para /events y para cargar las tareas activas"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_security_events_timestamp ON security_events(timestamp)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_security_events_type_timestamp "
+        "ON security_events(event_type, timestamp)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_tasks_active ON scheduled_tasks(active)")
+
+def migrate_event_user(conn):
+    """Usuario asociado a cada evento, para filtrar /events por usuario"""
+    conn.execute("ALTER TABLE security_events ADD COLUMN user_id INTEGER")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_security_events_user_timestamp "
+        "ON security_events(user_id, timestamp)"
+    )
+
+def migrate_event_rollups(conn):
+    """Tablas de totales por hora y por día para /stats, rellenadas con el historial"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_stats_hourly (
+            hour TEXT,
+            event_type TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, event_type)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_stats_daily (
+            day TEXT,
+            event_type TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, event_type)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(
+        "INSERT OR REPLACE INTO event_stats_hourly (hour, event_type, count) "
+        "SELECT strftime('%Y-%m-%d %H:00', timestamp), event_type, COUNT(*) "
+        "FROM security_events GROUP BY 1, 2"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO event_stats_daily (day, event_type, count) "
+        "SELECT date(timestamp), event_type, COUNT(*) FROM security_events GROUP BY 1, 2"
+    )
+
+def migrate_event_search(conn):
+    """Índice FTS5 sobre security_events.description, sincronizado con triggers"""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS security_events_fts USING fts5(
+            description,
+            content='security_events',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS security_events_fts_insert AFTER INSERT ON security_events BEGIN
+            INSERT INTO security_events_fts (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS security_events_fts_delete AFTER DELETE ON security_events BEGIN
+            INSERT INTO security_events_fts (security_events_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS security_events_fts_update AFTER UPDATE OF description ON security_events BEGIN
+            INSERT INTO security_events_fts (security_events_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+            INSERT INTO security_events_fts (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+    conn.execute("INSERT INTO security_events_fts (security_events_fts) VALUES ('rebuild')")
+
+MIGRATIONS = [
+    (1, "Tablas iniciales", migrate_initial_tables),
+    (2, "Columna last_run en scheduled_tasks", migrate_task_last_run),
+    (3, "Índices de security_events y scheduled_tasks", migrate_indexes),
+    (4, "Columna user_id en security_events", migrate_event_user),
+    (5, "Totales por hora y día de security_events", migrate_event_rollups),
+    (6, "Búsqueda de texto completo en security_events", migrate_event_search),
+]
+
+def apply_migrations(conn):
+    """Aplicar en orden las migraciones con versión mayor que la de la BD"""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        # Cada migración y su número de versión van en la misma transacción
+        conn.execute("BEGIN")
+        try:
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Migración {version} aplicada: {description}")
+
+class EventWriter:
+    """Escritor de security_events por lotes en segundo plano.
+
+    Los eventos se encolan en memoria y un hilo los inserta en una sola
+    transacción cada EVENT_BATCH_SIZE eventos o EVENT_FLUSH_INTERVAL segundos.
+    Con la cola llena los eventos nuevos se descartan contando cuántos de
+    cada tipo; el resumen se guarda como un único evento 'events_dropped'.
+    """
+
+    def __init__(self, database: Database, maxsize: int = EVENT_QUEUE_SIZE,
+                 batch_size: int = EVENT_BATCH_SIZE, interval: float = EVENT_FLUSH_INTERVAL):
+        self.database = database
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._dropped = collections.Counter()
+        self._dropped_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name='event-writer')
+        self._thread.start()
+
+    def stop(self):
+        """Detener el hilo escribiendo antes todo lo pendiente"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+        while True:
+            batch = self._drain(block=False)
+            pending = bool(batch)
+            self._flush(batch)
+            if not pending:
+                break
+
+    def put(self, event_type: str, description: str, photo_path: str = None, user_id: int = None,
+            count: int = 1) -> bool:
+        # La hora se toma al encolar (UTC, mismo formato que CURRENT_TIMESTAMP)
+        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            self._queue.put_nowait((event_type, description, photo_path, user_id, timestamp, count))
+            return True
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped[event_type] += 1
+            return False
+
+    def _drain(self, block: bool = True):
+        """Recoger hasta batch_size eventos, esperando como mucho `interval`"""
+        batch = []
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        with self._dropped_lock:
+            dropped, self._dropped = self._dropped, collections.Counter()
+        if dropped:
+            summary = ", ".join(f"{event_type}: {count}" for event_type, count in dropped.items())
+            logger.warning(f"Cola de eventos llena, descartados {sum(dropped.values())} ({summary})")
+            batch.append((
+                "events_dropped",
+                f"Eventos descartados por saturación: {summary}",
+                None,
+                None,
+                datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                1
+            ))
+        if not batch:
+            return
+        try:
+            self.database.call(write_events, batch)
+        except Exception as e:
+            logger.error(f"Error registrando {len(batch)} eventos: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush(self._drain())
+
+def write_events(conn, batch):
+    """Insertar un lote de eventos y actualizar sus totales en una sola transacción.
+
+    Cada evento suma `count` a los totales (un resumen de ráfaga cuenta
+    todas las detecciones que agrupa).
+    """
+    hourly = collections.Counter()
+    daily = collections.Counter()
+    for event_type, _, _, _, timestamp, count in batch:
+        hourly[(timestamp[:13] + ':00', event_type)] += count
+        daily[(timestamp[:10], event_type)] += count
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO security_events (event_type, description, photo_path, user_id, timestamp) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [event[:5] for event in batch]
+        )
+        conn.executemany(
+            "INSERT INTO event_stats_hourly (hour, event_type, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (hour, event_type) DO UPDATE SET count = count + excluded.count",
+            [(hour, event_type, count) for (hour, event_type), count in hourly.items()]
+        )
+        conn.executemany(
+            "INSERT INTO event_stats_daily (day, event_type, count) VALUES (?, ?, ?) "
+            "ON CONFLICT (day, event_type) DO UPDATE SET count = count + excluded.count",
+            [(day, event_type, count) for (day, event_type), count in daily.items()]
+        )
+
+event_writer = EventWriter(db)
+
+def log_security_event(event_type: str, description: str, photo_path: str = None, user_id: int = None,
+                       count: int = 1):
+    """Registrar evento de seguridad en la BD (se escribe por lotes, no bloquea)"""
+    if event_writer.put(event_type, description, photo_path, user_id, count):
         logger.info(f"Evento de seguridad registrado: {event_type} - {description}")
-    except Exception as e:
-        logger.error(f"Error registrando evento: {e}")
 
 # Decorador de autorización
 def authorized_only(func):
@@ -123,105 +525,1581 @@ def authorized_only(func):
         if user_id not in AUTHORIZED_USERS:
             await update.message.reply_text("⛔ Acceso denegado. No estás autorizado.")
             logger.warning(f"Intento de acceso no autorizado: {user_id} (@{username})")
-            log_security_event("unauthorized_access", f"Usuario {user_id} (@{username}) intentó acceder")
+            log_security_event(
+                "unauthorized_access", f"Usuario {user_id} (@{username}) intentó acceder", user_id=user_id
+            )
             return
         return await func(update, context)
     return wrapper
 
-# ===== DETECCIÓN DE MOVIMIENTO =====
+# ===== CÁMARA =====
+
+class CameraService:
+    """Hilo propietario de la cámara con buffer circular de los últimos frames.
+
+    Un único hilo mantiene abierto el dispositivo y decodifica frames en un
+    buffer preasignado; /photo y la detección de movimiento leen el frame más
+    reciente sin volver a abrir la cámara. Mientras nadie pide más frecuencia
+    se decodifica a CAMERA_IDLE_INTERVAL. Con CAMERA_IDLE_RELEASE > 0, si
+    nadie lee durante ese tiempo el hilo se detiene y libera el dispositivo;
+    la siguiente lectura lo vuelve a arrancar.
+    """
+
+    def __init__(self, device=CAMERA_DEVICE, width: int = CAMERA_WIDTH,
+                 height: int = CAMERA_HEIGHT, buffer_size: int = CAMERA_BUFFER_SIZE):
+        self.device = device
+        self.width = width
+        self.height = height
+        self.buffer_size = max(2, buffer_size)
+        self._cond = threading.Condition()
+        self._buffer = None  # np.ndarray (buffer_size, alto, ancho, 3), se asigna con el primer frame
+        self._latest = -1  # índice del último frame publicado
+        self._seq = 0  # total de frames capturados
+        self._first_seq = 0  # _seq al arrancar: los frames anteriores ya no son actuales
+        self._last_read = 0.0
+        self._frame_interval = CAMERA_IDLE_INTERVAL  # segundos mínimos entre lecturas (0 = sin límite)
+        self._running = False
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def set_frame_interval(self, seconds: float):
+        """Limitar la frecuencia de lectura (no se decodifican frames que nadie usa)"""
+        with self._cond:
+            if seconds < self._frame_interval:
+                # Despertar al hilo si estaba esperando con el intervalo anterior
+                self._cond.notify_all()
+            self._frame_interval = seconds
+
+    def start(self):
+        """Arrancar el hilo de captura si no está corriendo (cuenta como lectura)"""
+        with self._cond:
+            self._last_read = time.monotonic()
+            if self._running:
+                return
+            previous = self._thread
 
-def detect_motion():
-    """Thread para detectar movimiento con la cámara"""
-    global motion_detection_active, last_motion_time
-    
-    if not OPENCV_AVAILABLE:
-        logger.error("OpenCV no disponible. No se puede iniciar detección de movimiento.")
+        # Esperar a que el hilo anterior suelte el dispositivo antes de reabrirlo
+        if previous is not None:
+            previous.join(timeout=2)
+
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._first_seq = self._seq
+            self._thread = threading.Thread(target=self._run, daemon=True, name=f"camera-{self.device}")
+            self._thread.start()
+
+    def stop(self):
+        """Detener la captura y liberar el dispositivo"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def _open(self):
+        cap = cv2.VideoCapture(self.device)
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        # Evitar que el driver acumule frames viejos
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _run(self):
+        logger.info(f"Cámara {self.device} iniciada")
+        cap = self._open()
+        failures = 0
+
+        while self._running:
+            read_start = time.monotonic()
+            with self._cond:
+                if CAMERA_IDLE_RELEASE and read_start - self._last_read > CAMERA_IDLE_RELEASE:
+                    logger.info(f"Cámara {self.device} sin lecturas, liberando dispositivo")
+                    self._running = False
+                    self._cond.notify_all()
+                    break
+            slot = (self._latest + 1) % self.buffer_size
+            target = self._buffer[slot] if self._buffer is not None else None
+            ret, frame = cap.read(target) if target is not None else cap.read()
+
+            if not ret or frame is None:
+                failures += 1
+                if failures >= 10:
+                    logger.error(f"Cámara {self.device} sin frames, reabriendo dispositivo")
+                    cap.release()
+                    time.sleep(1)
+                    cap = self._open()
+                    failures = 0
+                else:
+                    time.sleep(0.1)
+                continue
+            failures = 0
+
+            if self._buffer is None or frame.shape != self._buffer.shape[1:]:
+                # Primer frame (o cambio de resolución): preasignar el buffer
+                with self._cond:
+                    self._buffer = np.empty((self.buffer_size,) + frame.shape, dtype=frame.dtype)
+                    self._latest = -1
+                slot = 0
+                target = self._buffer[slot]
+
+            # cap.read() escribe en el buffer si el tamaño coincide; si no, copiar
+            if not np.may_share_memory(frame, target):
+                np.copyto(target, frame)
+
+            with self._cond:
+                self._latest = slot
+                self._seq += 1
+                self._cond.notify_all()
+
+                if self._frame_interval > 0:
+                    self._cond.wait_for(
+                        lambda: not self._running
+                        or time.monotonic() - read_start >= self._frame_interval,
+                        timeout=self._frame_interval
+                    )
+
+        cap.release()
+        logger.info(f"Cámara {self.device} detenida")
+
+    def _wait(self, last_seq: int, timeout: float) -> bool:
+        return self._cond.wait_for(
+            lambda: self._seq > last_seq or not self._running, timeout=timeout
+        ) and self._seq > last_seq
+
+    def get_frame(self, copy: bool = True, timeout: float = CAMERA_FRAME_TIMEOUT):
+        """Devolver el frame más reciente (copia por defecto) o None si no hay"""
+        self.start()
+        with self._cond:
+            if not self._wait(self._first_seq, timeout):
+                return None
+            frame = self._buffer[self._latest]
+            return frame.copy() if copy else frame
+
+    def wait_for_frame(self, last_seq: int, copy: bool = True, timeout: float = CAMERA_FRAME_TIMEOUT):
+        """Esperar un frame más nuevo que last_seq. Devuelve (seq, frame) o (last_seq, None)
+
+        Con copy=False se devuelve una vista del buffer, válida solo hasta que
+        la cámara complete buffer_size - 1 frames más.
+        """
+        self.start()
+        with self._cond:
+            if not self._wait(max(last_seq, self._first_seq), timeout):
+                return last_seq, None
+            frame = self._buffer[self._latest]
+            return self._seq, (frame.copy() if copy else frame)
+
+# Un servicio por cámara configurada, por nombre
+cameras = {
+    cam['name']: CameraService(
+        cam.get('device', CAMERA_DEVICE), cam.get('width', CAMERA_WIDTH), cam.get('height', CAMERA_HEIGHT)
+    )
+    for cam in CAMERAS
+} if OPENCV_AVAILABLE else {}
+
+def run_in_bot_loop(coro):
+    """Programar una corrutina en el event loop del bot desde otro hilo"""
+    if bot_loop is None or bot_loop.is_closed():
+        logger.error("Event loop del bot no disponible, alerta descartada")
+        coro.close()
+        return None
+
+    def on_done(future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"Error en tarea del bot: {future.exception()}")
+
+    future = asyncio.run_coroutine_threadsafe(coro, bot_loop)
+    future.add_done_callback(on_done)
+    return future
+
+async def broadcast_media(upload, resend):
+    """Enviar un contenido a todos los usuarios autorizados subiéndolo una sola vez.
+
+    upload(user_id) lo sube y devuelve su referencia (file_id o lista de file_id);
+    resend(user_id, ref) lo reenvía por referencia. El primer envío que tiene
+    éxito sube el archivo; el resto reutiliza la referencia en paralelo
+    (limitado por ALERT_CONCURRENCY).
+    """
+    recipients = list(AUTHORIZED_USERS)
+    ref = None
+
+    # Subir hasta que un envío tenga éxito
+    while recipients and ref is None:
+        user_id = recipients.pop(0)
+        start = time.monotonic()
+        try:
+            ref = await upload(user_id)
+            logger.info(f"Alerta enviada a usuario {user_id} (subida, {time.monotonic() - start:.2f}s)")
+        except Exception as e:
+            logger.error(f"Error enviando alerta a {user_id}: {e}")
+
+    if ref is None:
         return
-    
-    logger.info("Iniciando detección de movimiento")
-    
+
+    semaphore = asyncio.Semaphore(ALERT_CONCURRENCY)
+
+    async def send_to(user_id):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await resend(user_id, ref)
+                logger.info(f"Alerta enviada a usuario {user_id} ({time.monotonic() - start:.2f}s)")
+            except Exception as e:
+                logger.error(f"Error enviando alerta a {user_id}: {e}")
+
+    await asyncio.gather(*(send_to(user_id) for user_id in recipients))
+
+async def broadcast_file(path: str, caption: str, parse_mode: str = None, kind: str = 'photo'):
+    """Enviar una foto (kind='photo') o un vídeo (kind='video') a los usuarios autorizados"""
+    bot = application.bot
+    send = bot.send_video if kind == 'video' else bot.send_photo
+
+    async def upload(user_id):
+        with open(path, 'rb') as media:
+            message = await send(user_id, media, caption=caption, parse_mode=parse_mode)
+        return message.video.file_id if kind == 'video' else message.photo[-1].file_id
+
+    async def resend(user_id, file_id):
+        await send(user_id, file_id, caption=caption, parse_mode=parse_mode)
+
+    await broadcast_media(upload, resend)
+
+async def broadcast_album(photo_paths: List[str], caption: str, parse_mode: str = None):
+    """Enviar un álbum de fotos a los usuarios autorizados"""
+    bot = application.bot
+
+    def album(items):
+        # El pie de foto del álbum va en el primer elemento
+        return [
+            InputMediaPhoto(item, caption=caption if i == 0 else None, parse_mode=parse_mode)
+            for i, item in enumerate(items)
+        ]
+
+    async def upload(user_id):
+        files = []
+        try:
+            files = [open(path, 'rb') for path in photo_paths]
+            messages = await bot.send_media_group(user_id, album(files))
+        finally:
+            for f in files:
+                f.close()
+        return [message.photo[-1].file_id for message in messages]
+
+    async def resend(user_id, file_ids):
+        await bot.send_media_group(user_id, album(file_ids))
+
+    await broadcast_media(upload, resend)
+
+async def send_motion_alert(photo_path: str, zone: str = None, camera: str = None):
+    """Enviar alerta de movimiento a usuarios autorizados"""
     try:
-        cap = cv2.VideoCapture(0)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        
-        # Leer primer frame
-        ret, frame1 = cap.read()
-        ret, frame2 = cap.read()
-        
-        while motion_detection_active:
+        camera_line = f"📷 Cámara: {html.escape(camera)}\n" if camera else ""
+        zone_line = f"📍 Zona: {html.escape(zone)}\n" if zone else ""
+        await broadcast_file(
+            photo_path,
+            caption="🚨 <b>ALERTA DE SEGURIDAD</b>\n\n"
+                    "⚠️ Movimiento detectado\n"
+                    f"{camera_line}"
+                    f"{zone_line}"
+                    f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.error(f"Error en send_motion_alert: {e}")
+
+async def send_motion_digest(photo_paths: List[str], count: int, seconds: float, zones: List[str],
+                             camera: str = None):
+    """Enviar el resumen de una ráfaga de movimiento a usuarios autorizados"""
+    try:
+        camera_line = f"📷 Cámara: {html.escape(camera)}\n" if camera else ""
+        zone_line = f"📍 Zonas: {html.escape(', '.join(zones))}\n" if zones else ""
+        caption = (
+            "🔁 <b>Movimiento continuado</b>\n\n"
+            f"🎥 {count} detecciones más en {seconds:.0f}s\n"
+            f"{camera_line}"
+            f"{zone_line}"
+            f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+        if len(photo_paths) == 1:
+            await broadcast_file(photo_paths[0], caption=caption, parse_mode='HTML')
+        else:
+            await broadcast_album(photo_paths, caption=caption, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error en send_motion_digest: {e}")
+
+async def send_motion_clip(clip_path: str, zone: str = None, camera: str = None):
+    """Enviar el clip de un movimiento a usuarios autorizados"""
+    try:
+        camera_line = f"\n📷 Cámara: {html.escape(camera)}" if camera else ""
+        zone_line = f"\n📍 Zona: {html.escape(zone)}" if zone else ""
+        await broadcast_file(
+            clip_path,
+            caption=f"🎬 Clip del movimiento{camera_line}{zone_line}",
+            parse_mode='HTML',
+            kind='video'
+        )
+    except Exception as e:
+        logger.error(f"Error en send_motion_clip: {e}")
+
+# ===== DETECCIÓN DE MOVIMIENTO =====
+
+class DropOldestQueue:
+    """Cola acotada entre hilos que descarta el elemento más viejo si está llena"""
+
+    def __init__(self, maxsize: int):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, item):
+        while True:
             try:
-                # Calcular diferencia entre frames
-                diff = cv2.absdiff(frame1, frame2)
-                gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-                blur = cv2.GaussianBlur(gray, (5, 5), 0)
-                _, thresh = cv2.threshold(blur, 20, 255, cv2.THRESH_BINARY)
-                dilated = cv2.dilate(thresh, None, iterations=3)
-                contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                
-                # Detectar movimiento significativo
-                motion_detected = False
-                for contour in contours:
-                    if cv2.contourArea(contour) > 5000:  # Área mínima
-                        motion_detected = True
-                        break
-                
-                if motion_detected:
-                    current_time = time.time()
-                    if current_time - last_motion_time > MOTION_COOLDOWN:
-                        last_motion_time = current_time
-                        logger.warning("¡MOVIMIENTO DETECTADO!")
-                        
-                        # Capturar foto
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        photo_path = f"media/motion_{timestamp}.jpg"
-                        cv2.imwrite(photo_path, frame1)
-                        
-                        # Registrar evento
-                        log_security_event("motion_detected", "Movimiento detectado", photo_path)
-                        
-                        # Enviar alerta (usar asyncio para llamar función async)
-                        import asyncio
-                        asyncio.run(send_motion_alert(photo_path))
-                
-                # Actualizar frames
-                frame1 = frame2
-                ret, frame2 = cap.read()
-                
-                time.sleep(0.1)
-                
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: float = None):
+        """Sacar un elemento; lanza queue.Empty si vence el timeout"""
+        return self._queue.get(timeout=timeout)
+
+class StageStats:
+    """Contadores de latencia de una etapa del pipeline"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def summary(self, dropped: int = 0) -> str:
+        with self._lock:
+            avg = self.total / self.count if self.count else 0.0
+            text = f"{self.name}: {avg * 1000:.0f} ms (máx {self.max * 1000:.0f} ms, {self.count})"
+        if dropped:
+            text += f", {dropped} descartados"
+        return text
+
+class MotionDetector:
+    """Interfaz de los motores de detección.
+
+    apply() recibe cada frame en gris (ya reducido y suavizado) y el
+    time.monotonic() de su captura, y devuelve una máscara binaria con los
+    píxeles en movimiento, o None mientras el motor todavía no tiene referencia.
+    """
+
+    def apply(self, gray, captured_at: float):
+        raise NotImplementedError
+
+class FrameDiffDetector(MotionDetector):
+    """Diferencia con el frame más reciente de al menos `min_interval` segundos antes.
+
+    Así el cambio medido no depende de los fps de análisis (ver
+    AdaptiveFrameRate): a fps altos se guardan los pocos frames del último
+    intervalo y se compara con el más viejo.
+    """
+
+    def __init__(self, threshold: int = MOTION_DIFF_THRESHOLD, min_interval: float = MOTION_DIFF_MIN_INTERVAL):
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self._history = collections.deque()  # (captured_at, gris) del último intervalo
+
+    def apply(self, gray, captured_at: float):
+        if self._history and self._history[0][1].shape != gray.shape:
+            self._history.clear()
+        self._history.append((captured_at, gray))
+        while len(self._history) > 2 and captured_at - self._history[1][0] >= self.min_interval:
+            self._history.popleft()
+        if len(self._history) < 2:
+            return None
+        diff = cv2.absdiff(self._history[0][1], gray)
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        return mask
+
+class RunningAverageDetector(MotionDetector):
+    """Fondo por media móvil: absorbe cambios lentos de luz y detecta movimiento lento"""
+
+    def __init__(self, alpha: float = MOTION_BACKGROUND_ALPHA, threshold: int = MOTION_DIFF_THRESHOLD):
+        self.alpha = alpha
+        self.threshold = threshold
+        self._background = None
+        self._background_u8 = None
+
+    def apply(self, gray, captured_at: float):
+        if self._background is None or self._background.shape != gray.shape:
+            self._background = gray.astype(np.float32)
+            self._background_u8 = gray.copy()
+            return None
+        cv2.convertScaleAbs(self._background, dst=self._background_u8)
+        diff = cv2.absdiff(gray, self._background_u8)
+        _, mask = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY)
+        cv2.accumulateWeighted(gray, self._background, self.alpha)
+        return mask
+
+class MOG2Detector(MotionDetector):
+    """Sustracción de fondo MOG2 de OpenCV (sin detección de sombras)"""
+
+    def __init__(self, history: int = MOTION_MOG2_HISTORY, var_threshold: float = MOTION_MOG2_VAR_THRESHOLD):
+        self._subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=history, varThreshold=var_threshold, detectShadows=False
+        )
+        self._frames = 0
+
+    def apply(self, gray, captured_at: float):
+        mask = self._subtractor.apply(gray)
+        self._frames += 1
+        # Los primeros frames solo sirven para aprender el fondo
+        return mask if self._frames > 1 else None
+
+MOTION_ENGINES = {
+    'diff': FrameDiffDetector,
+    'average': RunningAverageDetector,
+    'mog2': MOG2Detector,
+}
+
+def create_motion_detector(engine: str = MOTION_ENGINE, diff_threshold: int = MOTION_DIFF_THRESHOLD) -> MotionDetector:
+    """Crear el motor de detección configurado"""
+    if engine not in MOTION_ENGINES:
+        logger.error(f"Motor de detección desconocido '{engine}', usando 'diff'")
+        engine = 'diff'
+    if engine == 'mog2':
+        return MOG2Detector()
+    return MOTION_ENGINES[engine](threshold=diff_threshold)
+
+def changed_pixels_fire(mask, pixels: int = None, min_ratio: float = MOTION_MIN_CHANGED_RATIO) -> bool:
+    """Decidir si vale la pena buscar contornos según la fracción de píxeles cambiados.
+
+    `pixels` es el número de píxeles vigilados (por defecto todo el frame).
+    Con MOTION_GRID la máscara se reduce a una celda por píxel (INTER_AREA
+    promedia), así la fracción de cada celda sale de un único resize.
+    """
+    if MOTION_GRID:
+        columns, rows = MOTION_GRID
+        cells = cv2.resize(mask, (columns, rows), interpolation=cv2.INTER_AREA)
+        return int(cells.max()) >= MOTION_MIN_CELL_RATIO * 255
+    return cv2.countNonZero(mask) >= min_ratio * (pixels or mask.size)
+
+class ZoneLayout:
+    """Máscaras de las zonas vigiladas para un tamaño de frame de análisis.
+
+    El frame se recorta al rectángulo que contiene todas las zonas y los
+    píxeles fuera de ellas se ponen a cero antes de pasar al motor, así no
+    generan diferencias ni cuestan CPU en los pasos siguientes.
+    """
+
+    def __init__(self, zones: list, height: int, width: int, min_area: float = MOTION_MIN_AREA):
+        self.shape = (height, width)
+        if not zones:
+            # Sin zonas configuradas se vigila el frame completo
+            self.crop = None
+            self.mask = None
+            self.pixels = height * width
+            self.zones = [(None, None, min_area)]
+            return
+
+        union = np.zeros((height, width), dtype=np.uint8)
+        zone_masks = []
+        for zone in zones:
+            points = np.array(
+                [[round(x * (width - 1)), round(y * (height - 1))] for x, y in zone['polygon']],
+                dtype=np.int32
+            )
+            zone_mask = np.zeros((height, width), dtype=np.uint8)
+            cv2.fillPoly(zone_mask, [points], 255)
+            cv2.bitwise_or(union, zone_mask, dst=union)
+            zone_masks.append((zone.get('name'), zone_mask, zone.get('min_area', min_area)))
+
+        x, y, w, h = cv2.boundingRect(union)
+        self.crop = (slice(y, y + h), slice(x, x + w))
+        self.mask = union[self.crop].copy()
+        self.pixels = max(1, cv2.countNonZero(self.mask))
+        self.zones = [(name, zone_mask[self.crop].copy(), min_area) for name, zone_mask, min_area in zone_masks]
+
+class FrameAnalyzer:
+    """Análisis de un frame: reducción, motor de detección, vía rápida y zonas.
+
+    `settings` es la entrada de la cámara en security.cameras; sus claves
+    sustituyen a los umbrales globales. No depende del pipeline, así puede
+    ejecutarse tanto en un hilo como en un proceso aparte.
+    """
+
+    def __init__(self, settings: dict = None):
+        settings = settings or {}
+        self.min_area = settings.get('min_area', MOTION_MIN_AREA)
+        self.zones = settings.get('zones', MOTION_ZONES)
+        self.min_changed_ratio = settings.get('min_changed_ratio', MOTION_MIN_CHANGED_RATIO)
+        # Un motor nuevo por analizador, para no reutilizar un fondo antiguo
+        self.detector = create_motion_detector(
+            settings.get('motion_engine', MOTION_ENGINE), settings.get('diff_threshold', MOTION_DIFF_THRESHOLD)
+        )
+        self._layout = None  # ZoneLayout para el tamaño de análisis actual
+
+    def analyze(self, frame, captured_at: float):
+        """Analizar un frame capturado en `captured_at` (time.monotonic()).
+
+        Devuelve (área, zona, activo, nitidez): área 0 si no hay movimiento;
+        activo indica que la vía rápida detectó cambios.
+        """
+        # Se analiza una copia reducida en gris; el frame completo solo se usa para la foto
+        gray, scale_x, scale_y = self._prepare(frame)
+        mask = self.detector.apply(gray, captured_at)
+
+        # Vía rápida: en escenas quietas basta con contar píxeles cambiados
+        if mask is None or not changed_pixels_fire(mask, self._layout.pixels, self.min_changed_ratio):
+            return 0, None, False, 0.0
+
+        area, zone = self._find_motion(mask, scale_x, scale_y)
+        sharpness = 0.0
+        if area and MOTION_DIGEST_RANK == 'sharpness':
+            # Sobre el frame completo sin suavizar, que es el que se envía en la foto
+            full_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            sharpness = cv2.Laplacian(full_gray, cv2.CV_64F).var()
+        return area, zone, True, sharpness
+
+    def close(self):
+        pass
+
+    def _prepare(self, frame):
+        """Reducir el frame a la resolución de análisis y pasarlo a gris suavizado.
+
+        Devuelve (gris, escala_x, escala_y): factores lineales respecto al frame
+        original (iguales salvo por el redondeo del alto).
+        """
+        height, width = frame.shape[:2]
+        scale_x = scale_y = 1.0
+        if MOTION_ANALYSIS_WIDTH and width > MOTION_ANALYSIS_WIDTH:
+            analysis_height = max(1, round(height * MOTION_ANALYSIS_WIDTH / width))
+            scale_x = MOTION_ANALYSIS_WIDTH / width
+            scale_y = analysis_height / height
+            frame = cv2.resize(
+                frame, (MOTION_ANALYSIS_WIDTH, analysis_height), interpolation=cv2.INTER_AREA
+            )
+
+        if self._layout is None or self._layout.shape != frame.shape[:2]:
+            self._layout = ZoneLayout(self.zones, *frame.shape[:2], min_area=self.min_area)
+        layout = self._layout
+
+        # Recortar a las zonas antes de convertir y comparar
+        if layout.crop is not None:
+            frame = frame[layout.crop]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        kernel = (5, 5) if min(scale_x, scale_y) > 0.5 else (3, 3)
+        gray = cv2.GaussianBlur(gray, kernel, 0)
+        if layout.mask is not None:
+            cv2.bitwise_and(gray, layout.mask, dst=gray)
+        return gray, scale_x, scale_y
+
+    def _find_motion(self, mask, scale_x: float, scale_y: float):
+        """Mayor área (a resolución completa) que supera el mínimo de su zona.
+
+        Devuelve (área, nombre de la zona) o (0, None) si no hay movimiento.
+        """
+        dilated = cv2.dilate(mask, None, iterations=max(1, round(3 * min(scale_x, scale_y))))
+
+        best_area, best_zone = 0, None
+        for name, zone_mask, min_area in self._layout.zones:
+            zone_pixels = dilated if zone_mask is None else cv2.bitwise_and(dilated, zone_mask)
+            contours, _ = cv2.findContours(zone_pixels, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+            # Detectar movimiento significativo; el área se reescala a resolución completa
+            area = max((cv2.contourArea(contour) for contour in contours), default=0) / (scale_x * scale_y)
+            if area > min_area and area > best_area:
+                best_area, best_zone = area, name
+        return best_area, best_zone
+
+def analysis_worker(conn, settings: dict, shm_name: str, shape: tuple, dtype: str):
+    """Proceso de análisis: analiza el frame compartido cada vez que se le pide"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C lo gestiona el proceso del bot
+    # Un hilo de OpenCV por proceso: con una cámara por núcleo no se reparten la CPU
+    cv2.setNumThreads(1)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    analyzer = FrameAnalyzer(settings)
+    try:
+        conn.send(True)  # listo
+        while True:
+            captured_at = conn.recv()
+            if captured_at is None:
+                break
+            try:
+                conn.send(analyzer.analyze(frame, captured_at))
             except Exception as e:
-                logger.error(f"Error en detección de movimiento: {e}")
+                conn.send(RuntimeError(f"Error en proceso de análisis: {e}"))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del frame
+        shm.close()
+
+class AnalysisProcess:
+    """FrameAnalyzer en un proceso aparte, con la misma interfaz.
+
+    El frame se copia a un bloque de memoria compartida y por el pipe solo
+    viajan la orden y el resultado, así el análisis de cada cámara ocupa su
+    propio núcleo y no compite por el GIL con el event loop del bot. El
+    proceso se crea con el primer frame (y se recrea si cambia el tamaño o
+    deja de responder).
+    """
+
+    # spawn: un fork desde este proceso con varios hilos podría heredar locks tomados.
+    # El proceso nuevo importa el módulo (main() no se ejecuta) y recibe todo por argumentos
+    _context = multiprocessing.get_context('spawn')
+
+    def __init__(self, settings: dict, name: str):
+        self.settings = settings
+        self.name = name
+        self._shm = None
+        self._frame = None  # vista numpy del bloque compartido
+        self._conn = None
+        self._process = None
+
+    def _start(self, shape: tuple, dtype):
+        self.close()
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._frame = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self._conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+            target=analysis_worker,
+            args=(child_conn, self.settings, self._shm.name, shape, np.dtype(dtype).str),
+            daemon=True,
+            name=f'motion-analysis-{self.name}'
+        )
+        self._process.start()
+        child_conn.close()
+        if not self._conn.poll(MOTION_PROCESS_START_TIMEOUT):
+            self.close()
+            raise RuntimeError(f"El proceso de análisis de cámara {self.name} no arrancó")
+        try:
+            self._conn.recv()
+        except EOFError:
+            self.close()
+            raise RuntimeError(f"El proceso de análisis de cámara {self.name} terminó al arrancar")
+        logger.info(f"Proceso de análisis de cámara {self.name} iniciado (pid {self._process.pid})")
+
+    def analyze(self, frame, captured_at: float):
+        if self._frame is None or self._frame.shape != frame.shape or not self._process.is_alive():
+            self._start(frame.shape, frame.dtype)
+
+        np.copyto(self._frame, frame)
+        self._conn.send(captured_at)
+        if not self._conn.poll(MOTION_PROCESS_TIMEOUT):
+            self.close()  # se recrea con el siguiente frame
+            raise RuntimeError(f"El proceso de análisis de cámara {self.name} no responde")
+        result = self._conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        """Detener el proceso y liberar la memoria compartida"""
+        if self._process is not None:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+            self._conn.close()
+            self._process = None
+            self._conn = None
+        if self._shm is not None:
+            self._frame = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+class AdaptiveFrameRate:
+    """Frecuencia de análisis según la actividad de la escena.
+
+    Con la escena quieta se analizan MOTION_IDLE_FPS; tras cualquier cambio
+    se sube a MOTION_ACTIVE_FPS durante MOTION_ACTIVE_WINDOW segundos.
+    """
+
+    def __init__(self, idle_fps: float = MOTION_IDLE_FPS, active_fps: float = MOTION_ACTIVE_FPS,
+                 active_window: float = MOTION_ACTIVE_WINDOW):
+        self.idle_interval = 1 / idle_fps if idle_fps else 0.0
+        self.active_interval = 1 / active_fps if active_fps else 0.0
+        self.active_window = active_window
+        self._active_until = 0.0
+        self._wakeup = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return time.monotonic() < self._active_until
+
+    def activity(self):
+        """Registrar un cambio en la escena (despierta la captura si estaba en reposo)"""
+        was_active = self.active
+        self._active_until = time.monotonic() + self.active_window
+        if not was_active:
+            self._wakeup.set()
+
+    def interval(self) -> float:
+        return self.active_interval if self.active else self.idle_interval
+
+    def sleep(self, seconds: float):
+        """Dormir hasta `seconds` o hasta que haya actividad"""
+        self._wakeup.clear()
+        self._wakeup.wait(seconds)
+
+class ClipRecorder:
+    """Clips de vídeo con pre-roll y post-roll a partir de un buffer circular.
+
+    El buffer circular y la copia que usa el codificador se reservan una vez
+    como arrays fijos de numpy; en régimen normal cada frame solo se
+    redimensiona dentro de su hueco, sin reservar memoria. Al terminar el
+    post-roll el clip se copia y se codifica en un hilo aparte.
+    """
+
+    def __init__(self, on_clip, pre_seconds: float = CLIP_PRE_SECONDS, post_seconds: float = CLIP_POST_SECONDS,
+                 fps: float = CLIP_FPS, width: int = CLIP_WIDTH):
+        self.on_clip = on_clip  # on_clip(ruta, MotionEvent), llamado desde el hilo del codificador
+        self.fps = fps
+        self.pre_seconds = pre_seconds
+        self.post_frames = max(1, round(post_seconds * fps))
+        self.capacity = round(pre_seconds * fps) + self.post_frames + 1
+        self.width = width
+        self._ring = None  # (capacity, alto, ancho, 3), se reserva con el primer frame
+        self._clip = None  # misma forma, lo lee el codificador
+        self._times = np.zeros(self.capacity)
+        self._clip_times = np.zeros(self.capacity)
+        self._count = 0  # frames guardados desde el inicio
+        self._last_add = 0.0
+        self._start = 0  # primer frame (en cuenta absoluta) del clip en curso
+        self._post_remaining = 0
+        self._event = None
+        self._encoding = threading.Lock()
+
+    def add(self, frame, captured_at: float):
+        """Guardar un frame en el buffer (como mucho `fps` por segundo)"""
+        if captured_at - self._last_add < 1 / self.fps:
+            return
+        self._last_add = captured_at
+
+        if self._ring is None:
+            height = round(frame.shape[0] * self.width / frame.shape[1])
+            self._ring = np.empty((self.capacity, height, self.width, 3), dtype=np.uint8)
+            self._clip = np.empty_like(self._ring)
+
+        slot = self._count % self.capacity
+        cv2.resize(frame, (self.width, self._ring.shape[1]), dst=self._ring[slot], interpolation=cv2.INTER_AREA)
+        self._times[slot] = captured_at
+        self._count += 1
+
+        if self._post_remaining:
+            self._post_remaining -= 1
+            if not self._post_remaining:
+                self._finish()
+
+    def trigger(self, event) -> bool:
+        """Empezar un clip para este movimiento (se ignora si ya hay uno en curso)"""
+        if self._post_remaining or self._count == 0:
+            return False
+
+        # Pre-roll: frames de los últimos pre_seconds que sigan en el buffer
+        oldest = max(0, self._count - (self.capacity - self.post_frames))
+        start = self._count - 1
+        while start > oldest and self._times[(start - 1) % self.capacity] >= event.captured_at - self.pre_seconds:
+            start -= 1
+        self._start = start
+        self._post_remaining = self.post_frames
+        self._event = event
+        return True
+
+    def _finish(self):
+        if not self._encoding.acquire(blocking=False):
+            logger.warning("Codificador de clips ocupado, clip descartado")
+            return
+
+        frames = self._count - self._start
+        for i in range(frames):
+            slot = (self._start + i) % self.capacity
+            np.copyto(self._clip[i], self._ring[slot])
+            self._clip_times[i] = self._times[slot]
+
+        threading.Thread(
+            target=self._encode, args=(frames, self._event), daemon=True, name='clip-encoder'
+        ).start()
+
+    def _encode(self, frames: int, event):
+        try:
+            clip_path = f"media/clip_{event.camera}_{event.timestamp.strftime('%Y%m%d_%H%M%S')}.mp4"
+            height, width = self._clip.shape[1:3]
+            writer = cv2.VideoWriter(clip_path, cv2.VideoWriter_fourcc(*CLIP_CODEC), self.fps, (width, height))
+            for i in range(frames):
+                # Con la escena quieta se guardan menos fps: repetir frames para mantener el tiempo real
+                repeat = 1
+                if i + 1 < frames:
+                    repeat = max(1, round((self._clip_times[i + 1] - self._clip_times[i]) * self.fps))
+                for _ in range(repeat):
+                    writer.write(self._clip[i])
+            writer.release()
+            self.on_clip(clip_path, event)
+        except Exception as e:
+            logger.error(f"Error codificando clip: {e}")
+        finally:
+            self._encoding.release()
+
+class MotionDigest:
+    """Resumen de los movimientos agrupados tras una alerta"""
+
+    def __init__(self, events: list, count: int, seconds: float):
+        self.events = events  # mejores eventos, en orden cronológico
+        self.count = count  # movimientos detectados en la ventana
+        self.seconds = seconds
+        self.captured_at = time.monotonic()
+
+class AlertDigest:
+    """Agrupación de movimientos en ráfagas.
+
+    El primer movimiento abre una ventana y se avisa de inmediato; los
+    siguientes solo se cuentan y se conservan los `max_photos` mejores
+    (montículo de tamaño fijo). La ventana sigue abierta mientras haya
+    movimiento y se cierra tras `quiet` segundos de calma o al cumplir
+    `window` segundos; entonces se envían juntos en un álbum. Si el
+    movimiento continúa al cerrarse, la ventana siguiente no vuelve a
+    avisar de inmediato.
+    """
+
+    def __init__(self, window: float = MOTION_ALERT_WINDOW, quiet: float = MOTION_ALERT_QUIET,
+                 max_photos: int = MOTION_DIGEST_PHOTOS):
+        self.window = window
+        self.quiet = quiet
+        self.max_photos = max_photos
+        self._opened_at = None
+        self._last_at = None  # último movimiento, también entre ventanas
+        self._best = []  # montículo de (puntuación, orden, evento)
+        self._count = 0
+
+    def add(self, event) -> bool:
+        """Registrar un movimiento. Devuelve True si abre ráfaga y hay que avisar ya"""
+        ongoing = self._last_at is not None and event.captured_at - self._last_at < self.quiet
+        self._last_at = event.captured_at
+        if self._opened_at is None:
+            self._opened_at = event.captured_at
+            if not ongoing:
+                return True
+
+        self._count += 1
+        score = event.sharpness if MOTION_DIGEST_RANK == 'sharpness' else event.area
+        item = (score, self._count, event)
+        if len(self._best) < self.max_photos:
+            heapq.heappush(self._best, item)
+        elif score > self._best[0][0]:
+            heapq.heapreplace(self._best, item)
+        return False
+
+    def close_due(self, now: float) -> Optional[MotionDigest]:
+        """Cerrar la ventana si hay calma o ha vencido. Devuelve el resumen si hubo más movimientos"""
+        if self._opened_at is None:
+            return None
+        if now - self._last_at < self.quiet and now - self._opened_at < self.window:
+            return None
+        return self.flush(now)
+
+    def flush(self, now: float) -> Optional[MotionDigest]:
+        """Cerrar la ventana aunque no haya vencido (al detener la detección)"""
+        if self._opened_at is None:
+            return None
+
+        digest = None
+        if self._count:
+            events = [event for _, _, event in sorted(self._best, key=lambda item: item[1])]
+            digest = MotionDigest(events, self._count, now - self._opened_at)
+        self._opened_at = None
+        self._best = []
+        self._count = 0
+        return digest
+
+class MotionEvent:
+    """Movimiento detectado por la etapa de análisis"""
+
+    def __init__(self, frame, captured_at: float, area: float, zone: str = None, camera: str = None):
+        self.frame = frame
+        self.captured_at = captured_at  # time.monotonic() de la captura
+        self.timestamp = datetime.now()
+        self.area = area
+        self.zone = zone
+        self.camera = camera
+        self.sharpness = 0.0  # varianza del laplaciano, solo si digest_rank = "sharpness"
+
+class MotionRun:
+    """Estado de un arranque del pipeline.
+
+    Cada start() crea uno nuevo con su propio evento de parada, así los
+    hilos de un arranque anterior que aún no han salido (esperando un frame
+    o el proceso de análisis) no siguen trabajando al volver a activar.
+    """
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.frames = DropOldestQueue(MOTION_FRAME_QUEUE_SIZE)
+        self.digest = AlertDigest()
+        self.recorder = None
+
+class MotionPipeline:
+    """Detección de movimiento en tres etapas con colas acotadas.
+
+    - Captura (hilo): toma frames de la cámara compartida a frecuencia adaptativa.
+    - Análisis (hilo): compara cada frame con la referencia del motor y decide si hay movimiento.
+    - Aviso (corrutina en el event loop del bot): guarda la foto, registra el
+      evento y envía la alerta.
+
+    Entre etapas las colas descartan el elemento más viejo, así una subida
+    lenta a Telegram nunca frena la captura. Hay un pipeline por cámara;
+    `settings` es su entrada de security.cameras (ver FrameAnalyzer). Con
+    analysis_mode = "process" el hilo de análisis delega cada frame en un
+    AnalysisProcess.
+    """
+
+    def __init__(self, camera_service: CameraService, name: str, settings: dict = None):
+        self.camera = camera_service
+        self.name = name
+        self.settings = settings or {}
+        self._run = MotionRun()
+        self._run.stop.set()
+        self._alerts = None  # asyncio.Queue, se crea en el event loop del bot
+        self._alerts_dropped = 0
+        self._threads = []
+        self._notifier = None
+        self.frame_rate = AdaptiveFrameRate()
+        self.capture_stats = StageStats("Captura")
+        self.analysis_stats = StageStats("Análisis")
+        self.notify_stats = StageStats("Aviso")
+
+    @property
+    def running(self) -> bool:
+        return not self._run.stop.is_set()
+
+    def start(self):
+        """Arrancar las etapas (desde el event loop del bot)"""
+        if self.running:
+            return
+        logger.info(f"Iniciando detección de movimiento en cámara {self.name}")
+        run = self._run = MotionRun()
+        # La cola existe antes que los hilos: nada de lo que encolen se pierde
+        self._alerts = asyncio.Queue(maxsize=MOTION_ALERT_QUEUE_SIZE)
+        self._notifier = run_in_bot_loop(self._notify_loop())
+        self._threads = [
+            threading.Thread(target=self._capture_loop, args=(run,), daemon=True,
+                             name=f'motion-capture-{self.name}'),
+            threading.Thread(target=self._analysis_loop, args=(run,), daemon=True,
+                             name=f'motion-analysis-{self.name}'),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Detener las etapas (bloqueante: espera a que terminen los hilos).
+
+        Se llama fuera del event loop del bot, que debe seguir vivo: la ráfaga
+        abierta se envía como resumen y se esperan los avisos pendientes.
+        """
+        self._run.stop.set()
+        self.frame_rate.activity()  # despertar la captura si estaba en reposo
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+        # La cámara sigue abierta: que no decodifique a máxima velocidad
+        self.camera.set_frame_interval(CAMERA_IDLE_INTERVAL)
+        if self._notifier:
+            drained = run_in_bot_loop(self._drain_alerts(self._run.digest.flush(time.monotonic())))
+            if drained:
+                try:
+                    drained.result(timeout=MOTION_DRAIN_TIMEOUT)
+                except Exception as e:
+                    logger.error(f"Avisos de movimiento sin enviar al detener cámara {self.name}: {e}")
+            self._notifier.cancel()
+            self._notifier = None
+        logger.info(f"Detección de movimiento detenida en cámara {self.name} ({self.stats_summary()})")
+
+    def stats_summary(self) -> str:
+        return " | ".join([
+            self.capture_stats.summary(),
+            self.analysis_stats.summary(self._run.frames.dropped),
+            self.notify_stats.summary(self._alerts_dropped),
+        ])
+
+    # --- Etapa 1: captura ---
+
+    def _capture_loop(self, run: MotionRun):
+        seq = 0
+        while not run.stop.is_set():
+            start = time.monotonic()
+            interval = self.frame_rate.interval()
+            self.camera.set_frame_interval(interval)
+            seq, frame = self.camera.wait_for_frame(seq)
+            if frame is None:
+                logger.error(f"Error en detección de movimiento: cámara {self.name} sin frames")
                 time.sleep(1)
-        
-        cap.release()
-        logger.info("Detección de movimiento detenida")
-        
-    except Exception as e:
-        logger.error(f"Error fatal en detección de movimiento: {e}")
+                continue
+            captured_at = time.monotonic()
+            self.capture_stats.record(captured_at - start)
+            run.frames.put((captured_at, frame))
 
-async def send_motion_alert(photo_path: str):
-    """Enviar alerta de movimiento a usuarios autorizados"""
+            delay = interval - (time.monotonic() - start)
+            if delay > 0:
+                self.frame_rate.sleep(delay)
+
+    # --- Etapa 2: análisis ---
+
+    def _analysis_loop(self, run: MotionRun):
+        # Un analizador nuevo en cada arranque, para no reutilizar un fondo antiguo
+        if MOTION_ANALYSIS_MODE == 'process':
+            analyzer = AnalysisProcess(self.settings, self.name)
+        else:
+            analyzer = FrameAnalyzer(self.settings)
+        run.recorder = ClipRecorder(self._on_clip) if CLIP_ENABLED else None
+        try:
+            self._analyze_frames(analyzer, run)
+        finally:
+            analyzer.close()
+
+    def _analyze_frames(self, analyzer, run: MotionRun):
+        while not run.stop.is_set():
+            try:
+                digest = run.digest.close_due(time.monotonic())
+                if digest and bot_loop is not None:
+                    bot_loop.call_soon_threadsafe(self._enqueue_alert, digest)
+            except Exception as e:
+                logger.error(f"Error enviando resumen de movimiento: {e}")
+
+            try:
+                captured_at, frame = run.frames.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                if run.recorder:
+                    run.recorder.add(frame, captured_at)
+
+                area, zone, active, sharpness = analyzer.analyze(frame, captured_at)
+                if run.stop.is_set():
+                    break  # detenido mientras se analizaba: el resumen ya se cerró
+                if active:
+                    self.frame_rate.activity()
+                if area:
+                    event = MotionEvent(frame, captured_at, area, zone, self.name)
+                    event.sharpness = sharpness
+                    self._on_motion(event, run)
+            except Exception as e:
+                logger.error(f"Error en detección de movimiento: {e}")
+            self.analysis_stats.record(time.monotonic() - captured_at)
+
+    def _on_motion(self, event: MotionEvent, run: MotionRun):
+        if not run.digest.add(event):
+            return  # ráfaga en curso: se enviará en el resumen
+        logger.warning(f"¡MOVIMIENTO DETECTADO en cámara {self.name}!")
+        if run.recorder:
+            run.recorder.trigger(event)
+        if bot_loop is not None:
+            bot_loop.call_soon_threadsafe(self._enqueue_alert, event)
+
+    def _on_clip(self, clip_path: str, event: MotionEvent):
+        """Clip terminado (hilo del codificador): registrarlo y enviarlo"""
+        log_security_event("motion_clip", f"Clip de movimiento grabado en cámara {self.name}", clip_path)
+        run_in_bot_loop(send_motion_clip(clip_path, event.zone, self.name))
+
+    # --- Etapa 3: aviso (event loop del bot) ---
+
+    def _enqueue_alert(self, event):
+        """Encolar un MotionEvent o un MotionDigest para la etapa de aviso"""
+        if self._alerts is None:
+            return
+        if self._alerts.full():
+            self._alerts.get_nowait()
+            self._alerts.task_done()
+            self._alerts_dropped += 1
+        self._alerts.put_nowait(event)
+
+    async def _drain_alerts(self, digest: Optional[MotionDigest]):
+        """Encolar el último resumen y esperar a que la etapa de aviso vacíe la cola"""
+        if digest:
+            self._enqueue_alert(digest)
+        await self._alerts.join()
+
+    async def _send_digest(self, digest: MotionDigest):
+        loop = asyncio.get_running_loop()
+        photo_paths = []
+        for i, event in enumerate(digest.events):
+            photo_path = f"media/motion_{self.name}_{event.timestamp.strftime('%Y%m%d_%H%M%S')}_{i}.jpg"
+            await loop.run_in_executor(None, cv2.imwrite, photo_path, event.frame)
+            photo_paths.append(photo_path)
+
+        zones = sorted({event.zone for event in digest.events if event.zone})
+        # Cuenta como motion_detected con todas sus detecciones para que /stats no se quede corto
+        log_security_event(
+            "motion_detected",
+            f"{digest.count} movimientos agrupados en {digest.seconds:.0f}s en cámara {self.name}",
+            photo_paths[0],
+            count=digest.count
+        )
+        await send_motion_digest(photo_paths, digest.count, digest.seconds, zones, self.name)
+
+    async def _notify_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._alerts.get()
+            try:
+                await self._notify(loop, event)
+            finally:
+                self._alerts.task_done()
+            self.notify_stats.record(time.monotonic() - event.captured_at)
+
+    async def _notify(self, loop, event):
+        """Guardar, registrar y enviar un MotionEvent o un MotionDigest"""
+        if isinstance(event, MotionDigest):
+            try:
+                await self._send_digest(event)
+            except Exception as e:
+                logger.error(f"Error enviando resumen de movimiento: {e}")
+            return
+
+        try:
+            # Capturar foto
+            photo_path = f"media/motion_{self.name}_{event.timestamp.strftime('%Y%m%d_%H%M%S')}.jpg"
+            await loop.run_in_executor(None, cv2.imwrite, photo_path, event.frame)
+
+            # Registrar evento
+            description = f"Movimiento detectado en cámara {self.name}"
+            if event.zone:
+                description += f", zona {event.zone}"
+            log_security_event("motion_detected", description, photo_path)
+
+            await send_motion_alert(photo_path, event.zone, self.name)
+        except Exception as e:
+            logger.error(f"Error enviando aviso de movimiento: {e}")
+
+motion_pipelines = {
+    cam['name']: MotionPipeline(cameras[cam['name']], cam['name'], cam) for cam in CAMERAS
+} if OPENCV_AVAILABLE else {}
+
+def select_cameras(args: List[str]) -> List[str]:
+    """Cámaras pedidas en los argumentos de un comando (todas si no hay argumentos)"""
+    if not args:
+        return list(cameras)
+    unknown = [name for name in args if name not in cameras]
+    if unknown:
+        raise ValueError(
+            f"Cámara desconocida: {', '.join(unknown)}. Disponibles: {', '.join(cameras)}"
+        )
+    return args
+
+# ===== EJECUCIÓN DE COMANDOS =====
+
+command_slots = None  # asyncio.Semaphore global, se crea dentro del event loop
+user_command_slots = {}  # user_id -> asyncio.Semaphore
+
+def is_command_allowed(command: str) -> bool:
+    """Verificar si un comando está en la whitelist"""
+    return any(command.startswith(allowed) for allowed in COMMANDS_WHITELIST)
+
+def kill_process_group(proc):
+    """Matar el proceso y sus hijos (el shell lanza el comando en su propio grupo)"""
     try:
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
-        
-        for user_id in AUTHORIZED_USERS:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+class CommandOutput:
+    """Salida de un comando con memoria acotada.
+
+    Guarda en memoria como mucho `limit` bytes (el final de la salida); si la
+    salida los supera, todo se vuelca a un archivo temporal para adjuntarlo.
+    """
+
+    def __init__(self, limit: int = OUTPUT_MESSAGE_LIMIT):
+        self.limit = limit
+        self.size = 0
+        self._tail = bytearray()
+        self._spill = None
+
+    @property
+    def overflowed(self) -> bool:
+        return self._spill is not None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self._spill is None and len(self._tail) + len(data) > self.limit:
+            self._spill = tempfile.TemporaryFile(prefix='bot_output_')
+            self._spill.write(self._tail)
+        if self._spill is not None:
+            self._spill.write(data)
+        self._tail += data
+        if len(self._tail) > self.limit:
+            del self._tail[:len(self._tail) - self.limit]
+
+    @property
+    def omitted(self) -> int:
+        """Bytes de salida que ya no están en memoria"""
+        return self.size - len(self._tail)
+
+    def text(self) -> str:
+        """Texto para el mensaje: la salida completa o su parte final"""
+        return self._tail.decode(errors='replace')
+
+    def file(self):
+        """Archivo con la salida completa (solo si se desbordó)"""
+        if self._spill is not None:
+            self._spill.flush()
+            self._spill.seek(0)
+        return self._spill
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+class LiveMessage:
+    """Mensaje de Telegram que se edita como mucho una vez por intervalo"""
+
+    def __init__(self, message, interval: float = OUTPUT_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+        self._last_text = None
+
+    async def update(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if text == self._last_text or (not force and now - self._last_edit < self.interval):
+            return
+        self._last_edit = now
+        self._last_text = text
+        try:
+            await self.message.edit_text(text, parse_mode='HTML')
+        except Exception as e:
+            logger.warning(f"No se pudo editar el mensaje de salida: {e}")
+            if force:
+                # El resultado final no puede perderse: enviarlo en un mensaje nuevo
+                try:
+                    self.message = await self.message.reply_text(text, parse_mode='HTML')
+                except Exception as e:
+                    logger.error(f"No se pudo enviar el mensaje de salida: {e}")
+
+async def execute_command(command: str, output: CommandOutput, on_output=None,
+                          timeout: int = COMMAND_TIMEOUT) -> int:
+    """Ejecutar un comando sin bloquear el event loop y devolver su código de salida.
+
+    stdout y stderr se leen por bloques en `output`; `on_output` (corrutina
+    opcional) se llama tras cada bloque. Lanza asyncio.TimeoutError si supera
+    el timeout; el proceso se mata y `output` conserva lo leído hasta entonces.
+    """
+    proc = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True
+    )
+
+    async def pump():
+        while True:
+            data = await proc.stdout.read(OUTPUT_CHUNK_SIZE)
+            if not data:
+                break
+            output.write(data)
+            if on_output:
+                await on_output(output)
+        return await proc.wait()
+
+    try:
+        return await asyncio.wait_for(pump(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        kill_process_group(proc)
+        await proc.wait()
+        raise
+
+def format_command_output(command: str, output: CommandOutput, returncode: int = None) -> str:
+    """Mensaje HTML con el estado y la salida de un comando"""
+    if returncode is None:
+        header = f"⚙️ Ejecutando: {html.escape(command)}"
+    elif returncode == 0:
+        header = "✅ Resultado:"
+    else:
+        header = f"⚠️ Resultado (código {returncode}):"
+    note = f"... ({output.omitted} bytes anteriores en el adjunto)\n" if output.overflowed else ""
+    body = html.escape(output.text() or "(sin salida)")
+
+    # El límite de Telegram se aplica al texto ya escapado, que es más largo que la salida
+    # (margen de 64 para caracteres fuera del BMP, que Telegram cuenta dobles)
+    room = TELEGRAM_MESSAGE_LIMIT - len(header) - len("\n\n<code></code>") - 64
+    if len(note) + len(body) > room:
+        cut = len(body) - (room - len(note) - 20)  # 20: la nota puede crecer unos dígitos
+        # No partir una entidad HTML (&amp;, &quot;, ...)
+        amp = body.rfind('&', max(0, cut - 5), cut)
+        if amp != -1 and body.find(';', amp) >= cut:
+            cut = body.find(';', amp) + 1
+        omitted = len(html.unescape(body[:cut]).encode())
+        body = body[cut:]
+        if output.overflowed:
+            note = f"... ({output.omitted + omitted} bytes anteriores en el adjunto)\n"
+        else:
+            note = f"... ({omitted} bytes anteriores recortados)\n"
+    return f"{header}\n\n<code>{html.escape(note)}{body}</code>"
+
+def acquire_command_slots(user_id: int):
+    """Semáforos (global, por usuario) que limitan los comandos concurrentes"""
+    global command_slots
+    if command_slots is None:
+        command_slots = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+    if user_id not in user_command_slots:
+        user_command_slots[user_id] = asyncio.Semaphore(MAX_COMMANDS_PER_USER)
+    return user_command_slots[user_id], command_slots
+
+# ===== TAREAS PROGRAMADAS =====
+
+def next_run_time(schedule_time: str, after: datetime) -> datetime:
+    """Próxima ejecución diaria a las HH:MM estrictamente posterior a `after`"""
+    hour, minute = map(int, schedule_time.split(':'))
+    candidate = after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= after:
+        candidate += timedelta(days=1)
+    return candidate
+
+class TaskScheduler:
+    """Planificador en proceso para scheduled_tasks.
+
+    Las tareas activas se guardan en un heap ordenado por la próxima
+    ejecución. Altas en O(log n); las cancelaciones se marcan y el heap
+    descarta la entrada al llegar a la cima. El bucle duerme hasta el próximo
+    vencimiento y se despierta antes si cambia la cima del heap.
+    """
+
+    def __init__(self):
+        self._heap = []  # (timestamp de ejecución, task_id)
+        self._tasks = {}  # task_id -> dict(user_id, command, schedule_time, next_run)
+        self._wakeup = None
+        self._runner = None
+        self._executions = set()  # ejecuciones en curso (el loop solo guarda referencias débiles)
+
+    async def start(self):
+        """Cargar las tareas activas y arrancar el bucle"""
+        self._wakeup = asyncio.Event()
+        rows = await db.fetchall(
+            "SELECT id, user_id, command, schedule_time, last_run FROM scheduled_tasks WHERE active = 1"
+        )
+
+        now = datetime.now()
+        for task_id, user_id, command, schedule_time, last_run in rows:
+            # No repetir una ejecución que ya ocurrió antes de reiniciar
+            after = now
+            if last_run:
+                after = max(now, datetime.fromisoformat(last_run))
+            self.add(task_id, user_id, command, schedule_time, after=after)
+
+        self._runner = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Planificador iniciado con {len(self._tasks)} tareas")
+
+    async def stop(self):
+        if self._runner:
+            self._runner.cancel()
             try:
-                with open(photo_path, 'rb') as photo:
-                    await app.bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo,
-                        caption="🚨 <b>ALERTA DE SEGURIDAD</b>\n\n"
-                                "⚠️ Movimiento detectado\n"
-                                f"🕐 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                        parse_mode='HTML'
-                    )
-                logger.info(f"Alerta enviada a usuario {user_id}")
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+        # Cancelar las ejecuciones en curso y esperar a que terminen
+        executions = list(self._executions)
+        for execution in executions:
+            execution.cancel()
+        await asyncio.gather(*executions, return_exceptions=True)
+        self._executions.clear()
+
+    def add(self, task_id: int, user_id: int, command: str, schedule_time: str, after: datetime = None):
+        """Añadir (o reprogramar) una tarea"""
+        next_run = next_run_time(schedule_time, after or datetime.now()).timestamp()
+        self._tasks[task_id] = {
+            'user_id': user_id,
+            'command': command,
+            'schedule_time': schedule_time,
+            'next_run': next_run,
+        }
+        heapq.heappush(self._heap, (next_run, task_id))
+        if self._wakeup and self._heap[0] == (next_run, task_id):
+            self._wakeup.set()
+
+    def cancel(self, task_id: int):
+        """Cancelar una tarea; su entrada del heap se descarta de forma perezosa"""
+        self._tasks.pop(task_id, None)
+
+    def _is_stale(self, entry) -> bool:
+        next_run, task_id = entry
+        task = self._tasks.get(task_id)
+        return task is None or task['next_run'] != next_run
+
+    async def _run(self):
+        while True:
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            delay = self._heap[0][0] - time.time() if self._heap else SCHEDULER_MAX_SLEEP
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, SCHEDULER_MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            fire_time, task_id = heapq.heappop(self._heap)
+            task = self._tasks[task_id]
+
+            # Registrar la ejecución antes de lanzarla para no repetirla tras un reinicio
+            fired_at = datetime.fromtimestamp(fire_time)
+            try:
+                await db.execute(
+                    "UPDATE scheduled_tasks SET last_run = ? WHERE id = ?",
+                    (fired_at.isoformat(sep=' '), task_id)
+                )
             except Exception as e:
-                logger.error(f"Error enviando alerta a {user_id}: {e}")
-                
-    except Exception as e:
-        logger.error(f"Error en send_motion_alert: {e}")
+                logger.error(f"Error registrando ejecución de tarea {task_id}: {e}")
+
+            self.add(task_id, task['user_id'], task['command'], task['schedule_time'], after=fired_at)
+            execution = asyncio.get_running_loop().create_task(self._execute(task_id, task))
+            self._executions.add(execution)
+            execution.add_done_callback(self._executions.discard)
+
+    async def _execute(self, task_id: int, task: dict):
+        """Ejecutar una tarea por el mismo camino que /run"""
+        command = task['command']
+        user_id = task['user_id']
+        logger.info(f"Ejecutando tarea programada {task_id}: {command}")
+
+        try:
+            if not is_command_allowed(command):
+                log_security_event("blocked_command", f"Tarea {task_id} no permitida: {command}", user_id=user_id)
+                await application.bot.send_message(
+                    chat_id=user_id, text=f"⛔ Tarea {task_id} no permitida: {command}"
+                )
+                return
+
+            await application.bot.send_message(chat_id=user_id, text=f"⏰ Tarea programada {task_id}")
+            user_slot, global_slot = acquire_command_slots(user_id)
+            async with user_slot, global_slot:
+                await stream_command(application.bot, user_id, command, user_id=user_id)
+
+        except Exception as e:
+            logger.error(f"Error ejecutando tarea {task_id}: {e}")
+
+scheduler = TaskScheduler()
+
+# ===== RETENCIÓN =====
+
+def delete_events_batch(conn, cutoff: str):
+    """Borrar un lote de eventos anteriores a `cutoff`. Devuelve sus photo_path"""
+    rows = conn.execute(
+        "SELECT id, photo_path FROM security_events WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+        (cutoff, RETENTION_BATCH_SIZE)
+    ).fetchall()
+    if rows:
+        with conn:
+            conn.executemany("DELETE FROM security_events WHERE id = ?", [(row[0],) for row in rows])
+    return [row[1] for row in rows]
+
+def compact_database(conn):
+    """Devolver al sistema las páginas libres de la BD"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if not RETENTION_FULL_VACUUM:
+            return
+        # Pasar a auto_vacuum incremental requiere un VACUUM completo (solo la primera vez)
+        logger.info("Activando auto_vacuum incremental (VACUUM completo)")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    # executescript recorre la sentencia entera; execute() solo liberaría una página
+    conn.executescript("PRAGMA incremental_vacuum")
+
+def prune_media(max_age_days: int, max_bytes: int):
+    """Borrar archivos de media/ por antigüedad y después los más viejos hasta caber en max_bytes"""
+    files = []
+    for path in MEDIA_DIR.iterdir():
+        if path.is_file() and not path.name.startswith('.'):
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    freed = 0
+    for mtime, size, path in files:
+        too_old = cutoff is not None and mtime < cutoff
+        too_big = max_bytes and total > max_bytes
+        if not (too_old or too_big):
+            break
+        try:
+            path.unlink()
+            removed += 1
+            freed += size
+            total -= size
+        except OSError as e:
+            logger.error(f"No se pudo borrar {path}: {e}")
+    return removed, freed
+
+def remove_files(paths):
+    removed = 0
+    for photo_path in paths:
+        try:
+            os.remove(photo_path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"No se pudo borrar {photo_path}: {e}")
+    return removed
+
+async def run_retention():
+    """Aplicar la política de retención una vez"""
+    loop = asyncio.get_running_loop()
+    deleted_events = 0
+    deleted_files = 0
+
+    if EVENTS_MAX_AGE_DAYS:
+        cutoff = (datetime.utcnow() - timedelta(days=EVENTS_MAX_AGE_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        while True:
+            # Un lote por transacción para no bloquear al resto de escrituras
+            photo_paths = await db.run(delete_events_batch, cutoff)
+            deleted_events += len(photo_paths)
+            deleted_files += await loop.run_in_executor(None, remove_files, [p for p in photo_paths if p])
+            if len(photo_paths) < RETENTION_BATCH_SIZE:
+                break
+
+    removed, freed = await loop.run_in_executor(
+        None, prune_media, MEDIA_MAX_AGE_DAYS, MEDIA_MAX_MB * 1024 * 1024
+    )
+    deleted_files += removed
+
+    await db.run(compact_database)
+
+    summary = f"Retención: {deleted_events} eventos y {deleted_files} archivos borrados ({freed // (1024 * 1024)} MB de media)"
+    logger.info(summary)
+    if deleted_events or deleted_files:
+        log_security_event("retention_cleanup", summary)
+
+async def retention_loop():
+    """Tarea en segundo plano que aplica la retención periódicamente"""
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logger.error(f"Error aplicando retención: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
 
 # ===== COMANDOS DEL BOT =====
 
@@ -243,9 +2121,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 <b>🔹 Monitoreo y Seguridad</b>
 /status - Estado del sistema
-/photo - Capturar foto ahora
-/motion - Activar/desactivar detección
+/photo [cámara] - Capturar foto ahora
+/motion [cámara] - Activar/desactivar detección
 /events - Ver últimos eventos de seguridad
+/stats [días] - Estadísticas de eventos
+/search texto - Buscar en los eventos
 
 <b>🔹 Ejecución de Comandos</b>
 /run comando - Ejecutar comando de whitelist
@@ -298,7 +2178,13 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # IP
         ip = subprocess.check_output(['hostname', '-I']).decode().strip().split()[0]
 
-        motion_status = '✅ Activa' if motion_detection_active else '❌ Inactiva'
+        motion_status = ''
+        for name, pipeline in motion_pipelines.items():
+            motion_status += f"\n📷 {html.escape(name)}: " + ('✅ Activa' if pipeline.running else '❌ Inactiva')
+            if pipeline.running:
+                motion_status += f"\n⏱️ {pipeline.stats_summary()}"
+        if not motion_pipelines:
+            motion_status = '❌ Inactiva'
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         
         status_text = f"""📊 <b>Estado del Sistema</b>
@@ -326,37 +2212,55 @@ Total: {disk_total} | Usado: {disk_used} ({disk_percent})
 
 @authorized_only
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Capturar foto"""
+    """Capturar foto: /photo [cámara] (sin argumento, una por cámara)"""
     await update.message.reply_text("📸 Capturando foto...")
 
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        photo_path = f"media/photo_{timestamp}.jpg"
-
-        if OPENCV_AVAILABLE:
-            # Capturar con OpenCV
-            cap = cv2.VideoCapture(0)
-            ret, frame = cap.read()
-            if ret:
-                cv2.imwrite(photo_path, frame)
-            cap.release()
-        else:
+
+        if not OPENCV_AVAILABLE:
             # Fallback a fswebcam
+            photo_path = f"media/photo_{timestamp}.jpg"
             subprocess.run([
                 'fswebcam',
                 '-r', '1280x720',
                 '--no-banner',
                 photo_path
             ], check=True)
+            with open(photo_path, 'rb') as photo_file:
+                await update.message.reply_photo(
+                    photo=photo_file,
+                    caption=f"📸 Foto capturada\n🕐 {timestamp}"
+                )
+            logger.info(f"Foto capturada: {photo_path}")
+            return
 
-        # Enviar foto
-        with open(photo_path, 'rb') as photo_file:
-            await update.message.reply_photo(
-                photo=photo_file,
-                caption=f"📸 Foto capturada\n🕐 {timestamp}"
-            )
+        for name in select_cameras(context.args or []):
+            photo_path = f"media/photo_{name}_{timestamp}.jpg"
 
-        logger.info(f"Foto capturada: {photo_path}")
+            # Tomar el último frame de la cámara compartida
+            def capture(camera=cameras[name], path=photo_path):
+                frame = camera.get_frame()
+                if frame is None:
+                    raise RuntimeError(f"La cámara {name} no entregó ningún frame")
+                cv2.imwrite(path, frame)
+
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, capture)
+            except RuntimeError as e:
+                # Una cámara caída no impide enviar las fotos del resto
+                logger.error(f"Error capturando foto: {e}")
+                await update.message.reply_text(f"❌ Error: {str(e)}")
+                continue
+
+            # Enviar foto
+            with open(photo_path, 'rb') as photo_file:
+                await update.message.reply_photo(
+                    photo=photo_file,
+                    caption=f"📸 Foto capturada\n📷 Cámara: {name}\n🕐 {timestamp}"
+                )
+
+            logger.info(f"Foto capturada: {photo_path}")
 
     except Exception as e:
         logger.error(f"Error capturando foto: {e}")
@@ -364,52 +2268,279 @@ async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @authorized_only
 async def toggle_motion(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Activar/desactivar detección de movimiento"""
-    global motion_detection_active, motion_thread
+    """Activar/desactivar detección de movimiento: /motion [cámara]
 
+    Sin argumento se desactivan todas si alguna está activa, o se activan todas.
+    """
     if not OPENCV_AVAILABLE:
         await update.message.reply_text("❌ OpenCV no está instalado. Instala con: pip install opencv-python")
         return
 
-    if not motion_detection_active:
-        motion_detection_active = True
-        motion_thread = threading.Thread(target=detect_motion, daemon=True)
-        motion_thread.start()
-        await update.message.reply_text("✅ Detección de movimiento ACTIVADA\n🚨 Recibirás alertas automáticas")
-        log_security_event("motion_enabled", "Detección de movimiento activada")
+    try:
+        names = select_cameras(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Error: {str(e)}")
+        return
+
+    pipelines = [motion_pipelines[name] for name in names]
+    camera_list = ', '.join(names)
+    if not any(pipeline.running for pipeline in pipelines):
+        for pipeline in pipelines:
+            pipeline.start()
+        await update.message.reply_text(
+            f"✅ Detección de movimiento ACTIVADA\n📷 {camera_list}\n🚨 Recibirás alertas automáticas"
+        )
+        log_security_event(
+            "motion_enabled", f"Detección de movimiento activada ({camera_list})", user_id=update.effective_user.id
+        )
+    else:
+        running = [pipeline for pipeline in pipelines if pipeline.running]
+        await asyncio.gather(*(
+            asyncio.get_running_loop().run_in_executor(None, pipeline.stop) for pipeline in running
+        ))
+        camera_list = ', '.join(pipeline.name for pipeline in running)
+        await update.message.reply_text(f"❌ Detección de movimiento DESACTIVADA\n📷 {camera_list}")
+        log_security_event(
+            "motion_disabled", f"Detección de movimiento desactivada ({camera_list})", user_id=update.effective_user.id
+        )
+
+def parse_event_filters(args: List[str]) -> dict:
+    """Filtros de /events: [tipo] [tipo=X] [usuario=ID] [desde=AAAA-MM-DD] [hasta=AAAA-MM-DD]"""
+    filters_ = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep:
+            key, value = 'tipo', arg
+        key = key.lower()
+        if key == 'tipo':
+            filters_['tipo'] = value
+        elif key == 'usuario':
+            filters_['usuario'] = int(value)
+        elif key in ('desde', 'hasta'):
+            datetime.strptime(value, '%Y-%m-%d')
+            filters_[key] = value
+        else:
+            raise ValueError(f"Filtro desconocido: {key}")
+    return filters_
+
+async def fetch_events_page(filters_: dict, cursor=None, direction: str = 'older'):
+    """Página de eventos con paginación por clave (timestamp, id).
+
+    `cursor` es el (timestamp, id) del borde de la página actual; 'older'
+    devuelve los anteriores y 'newer' los siguientes. Devuelve (filas de más
+    nuevo a más viejo, hay_más_en_esa_dirección).
+    """
+    conditions = []
+    params = []
+    if 'tipo' in filters_:
+        conditions.append("event_type = ?")
+        params.append(filters_['tipo'])
+    if 'usuario' in filters_:
+        conditions.append("user_id = ?")
+        params.append(filters_['usuario'])
+    if 'desde' in filters_:
+        conditions.append("timestamp >= ?")
+        params.append(filters_['desde'])
+    if 'hasta' in filters_:
+        end = datetime.strptime(filters_['hasta'], '%Y-%m-%d') + timedelta(days=1)
+        conditions.append("timestamp < ?")
+        params.append(end.strftime('%Y-%m-%d'))
+
+    if direction == 'newer':
+        order = "ASC"
+        if cursor:
+            conditions.append("(timestamp, id) > (?, ?)")
+            params.extend(cursor)
     else:
-        motion_detection_active = False
-        if motion_thread:
-            motion_thread.join(timeout=2)
-        await update.message.reply_text("❌ Detección de movimiento DESACTIVADA")
-        log_security_event("motion_disabled", "Detección de movimiento desactivada")
+        order = "DESC"
+        if cursor:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(cursor)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = await db.fetchall(
+        f"SELECT id, event_type, description, timestamp FROM security_events {where} "
+        f"ORDER BY timestamp {order}, id {order} LIMIT ?",
+        params + [EVENTS_PAGE_SIZE + 1]
+    )
+
+    has_more = len(rows) > EVENTS_PAGE_SIZE
+    rows = rows[:EVENTS_PAGE_SIZE]
+    if direction == 'newer':
+        rows.reverse()
+    return rows, has_more
+
+def render_events_page(rows, filters_: dict, filter_key: int, has_older: bool, has_newer: bool):
+    """Texto y botones de una página de /events"""
+    events_text = "🔐 <b>Últimos Eventos de Seguridad</b>\n"
+    if filters_:
+        events_text += "🔎 " + html.escape(" ".join(f"{k}={v}" for k, v in filters_.items())) + "\n"
+    events_text += "\n"
+    for event_id, event_type, description, timestamp in rows:
+        events_text += (
+            f"• <b>{html.escape(event_type or '')}</b>\n  {html.escape(description or '')}\n  🕐 {timestamp}\n\n"
+        )
+
+    buttons = []
+    if has_newer:
+        _, _, _, timestamp = rows[0]
+        buttons.append(InlineKeyboardButton("⬅️ Más nuevos", callback_data=f"ev|n|{timestamp}|{rows[0][0]}|{filter_key}"))
+    if has_older:
+        _, _, _, timestamp = rows[-1]
+        buttons.append(InlineKeyboardButton("Más viejos ➡️", callback_data=f"ev|o|{timestamp}|{rows[-1][0]}|{filter_key}"))
+    return events_text, InlineKeyboardMarkup([buttons]) if buttons else None
 
 @authorized_only
 async def security_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Ver últimos eventos de seguridad"""
+    """Ver eventos de seguridad con filtros y paginación"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            "SELECT event_type, description, timestamp FROM security_events ORDER BY timestamp DESC LIMIT 10"
+        filters_ = parse_event_filters(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ {e}\n\nUso: /events [tipo] [usuario=ID] [desde=AAAA-MM-DD] [hasta=AAAA-MM-DD]"
         )
-        events = c.fetchall()
-        conn.close()
+        return
+
+    try:
+        events, has_older = await fetch_events_page(filters_)
 
         if not events:
             await update.message.reply_text("📋 No hay eventos de seguridad registrados")
             return
 
-        events_text = "🔐 <b>Últimos Eventos de Seguridad</b>\n\n"
-        for event_type, description, timestamp in events:
-            events_text += f"• <b>{event_type}</b>\n  {description}\n  🕐 {timestamp}\n\n"
+        # Los filtros se guardan en user_data; los botones solo llevan su clave
+        saved = context.user_data.setdefault('event_filters', {})
+        filter_key = max(saved, default=0) + 1
+        saved[filter_key] = filters_
+        for old_key in sorted(saved)[:-20]:
+            del saved[old_key]
 
-        await update.message.reply_text(events_text, parse_mode='HTML')
+        events_text, reply_markup = render_events_page(events, filters_, filter_key, has_older, False)
+        await update.message.reply_text(events_text, reply_markup=reply_markup, parse_mode='HTML')
 
     except Exception as e:
         logger.error(f"Error listando eventos: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
+async def events_page_button(query, context: ContextTypes.DEFAULT_TYPE):
+    """Botones de /events: cargar la página anterior o siguiente"""
+    if query.from_user.id not in AUTHORIZED_USERS:
+        return
+
+    _, direction, timestamp, event_id, filter_key = query.data.split('|')
+    filters_ = context.user_data.get('event_filters', {}).get(int(filter_key))
+    if filters_ is None:
+        await query.edit_message_text("⌛ Búsqueda caducada, vuelve a usar /events")
+        return
+
+    direction = 'newer' if direction == 'n' else 'older'
+    events, has_more = await fetch_events_page(filters_, (timestamp, int(event_id)), direction)
+    if not events:
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    if direction == 'newer':
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, True
+    events_text, reply_markup = render_events_page(events, filters_, int(filter_key), has_older, has_newer)
+    await query.edit_message_text(events_text, reply_markup=reply_markup, parse_mode='HTML')
+
+@authorized_only
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Estadísticas de eventos de los últimos N días (desde las tablas de totales)"""
+    try:
+        days = int(context.args[0]) if context.args else STATS_DEFAULT_DAYS
+    except ValueError:
+        await update.message.reply_text("❌ Uso: /stats [días]")
+        return
+    days = max(1, min(days, STATS_MAX_DAYS))
+
+    try:
+        now = datetime.utcnow()
+        types = [event_type for event_type, _, _ in STATS_EVENT_TYPES]
+        placeholders = ", ".join("?" for _ in types)
+
+        first_day = (now - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        daily_rows = await db.fetchall(
+            f"SELECT day, event_type, count FROM event_stats_daily "
+            f"WHERE day >= ? AND event_type IN ({placeholders})",
+            [first_day] + types
+        )
+        first_hour = (now - timedelta(hours=23)).strftime('%Y-%m-%d %H:00')
+        hourly_rows = await db.fetchall(
+            "SELECT hour, count FROM event_stats_hourly WHERE hour >= ? AND event_type = ?",
+            (first_hour, "motion_detected")
+        )
+
+        per_day = collections.defaultdict(collections.Counter)
+        totals = collections.Counter()
+        for day, event_type, count in daily_rows:
+            per_day[day][event_type] += count
+            totals[event_type] += count
+
+        stats_text = f"📈 <b>Estadísticas (últimos {days} días)</b>\n\n"
+        for event_type, icon, label in STATS_EVENT_TYPES:
+            stats_text += f"{icon} {label}: {totals[event_type]}\n"
+
+        stats_text += "\n<b>Por día</b>\n"
+        for offset in range(days - 1, -1, -1):
+            day = (now - timedelta(days=offset)).strftime('%Y-%m-%d')
+            counts = " | ".join(f"{icon} {per_day[day][event_type]}" for event_type, icon, _ in STATS_EVENT_TYPES)
+            stats_text += f"<code>{day}</code> {counts}\n"
+
+        motion_by_hour = dict(hourly_rows)
+        peak = max(motion_by_hour.values(), default=0)
+        stats_text += "\n<b>🎥 Movimiento por hora (24 h, UTC)</b>\n"
+        for offset in range(23, -1, -1):
+            hour = (now - timedelta(hours=offset)).strftime('%Y-%m-%d %H:00')
+            count = motion_by_hour.get(hour, 0)
+            bar = "▇" * (round(10 * count / peak) if peak else 0)
+            stats_text += f"<code>{hour[11:]}</code> {bar} {count}\n"
+
+        await update.message.reply_text(stats_text, parse_mode='HTML')
+
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas: {e}")
+        await update.message.reply_text(f"❌ Error: {str(e)}")
+
+def build_search_query(text: str) -> str:
+    """Consulta FTS5 segura: cada palabra entre comillas y como prefijo"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+@authorized_only
+async def search_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Buscar eventos por texto en su descripción"""
+    if not context.args:
+        await update.message.reply_text("❌ Uso: /search texto\n\nEjemplo: /search backup")
+        return
+
+    text = ' '.join(context.args)
+    try:
+        # \x02 y \x03 marcan las coincidencias; se sustituyen por <b> tras escapar el HTML
+        results = await db.fetchall(
+            "SELECT e.event_type, highlight(security_events_fts, 0, char(2), char(3)), e.timestamp "
+            "FROM security_events_fts JOIN security_events e ON e.id = security_events_fts.rowid "
+            "WHERE security_events_fts MATCH ? ORDER BY rank LIMIT ?",
+            (build_search_query(text), SEARCH_RESULTS)
+        )
+
+        if not results:
+            await update.message.reply_text(f"🔍 Sin resultados para: {text}")
+            return
+
+        results_text = f"🔍 <b>Resultados para:</b> {html.escape(text)}\n\n"
+        for event_type, description, timestamp in results:
+            description = html.escape(description or '').replace('\x02', '<b>').replace('\x03', '</b>')
+            results_text += f"• <b>{html.escape(event_type or '')}</b>\n  {description}\n  🕐 {timestamp}\n\n"
+
+        await update.message.reply_text(results_text, parse_mode='HTML')
+
+    except Exception as e:
+        logger.error(f"Error buscando eventos: {e}")
+        await update.message.reply_text(f"❌ Error: {str(e)}")
+
 @authorized_only
 async def run_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ejecutar comando de whitelist"""
@@ -423,35 +2554,56 @@ async def run_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     command = ' '.join(context.args)
 
-    if not any(command.startswith(allowed) for allowed in COMMANDS_WHITELIST):
+    if not is_command_allowed(command):
         await update.message.reply_text(f"⛔ Comando no permitido: {command}")
-        log_security_event("blocked_command", f"Intento de ejecutar: {command}")
+        log_security_event(
+            "blocked_command", f"Intento de ejecutar: {command}", user_id=update.effective_user.id
+        )
         return
 
-    try:
-        await update.message.reply_text(f"⚙️ Ejecutando: {command}")
-
-        result = subprocess.run(
-            command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=30
-        )
+    user_slot, global_slot = acquire_command_slots(update.effective_user.id)
 
-        output = result.stdout if result.stdout else result.stderr
-        if len(output) > 3900:
-            output = output[:3900] + "\n\n... (truncado)"
+    try:
+        if user_slot.locked() or global_slot.locked():
+            await update.message.reply_text(f"⏳ En cola: {command}")
 
-        await update.message.reply_text(f"✅ Resultado:\n\n<code>{output}</code>", parse_mode='HTML')
-        log_security_event("command_executed", f"Ejecutado: {command}")
+        async with user_slot, global_slot:
+            await stream_command(
+                context.bot, update.effective_chat.id, command, user_id=update.effective_user.id
+            )
 
-    except subprocess.TimeoutExpired:
-        await update.message.reply_text("⏱️ Timeout (30s)")
     except Exception as e:
         logger.error(f"Error ejecutando comando: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
+async def stream_command(bot, chat_id: int, command: str, user_id: int = None):
+    """Ejecutar un comando mostrando su salida en un único mensaje que se va editando"""
+    output = CommandOutput()
+    message = await bot.send_message(chat_id=chat_id, text=f"⚙️ Ejecutando: {command}")
+    live = LiveMessage(message)
+
+    async def on_output(out):
+        await live.update(format_command_output(command, out))
+
+    try:
+        try:
+            returncode = await execute_command(command, output, on_output=on_output)
+            await live.update(format_command_output(command, output, returncode), force=True)
+            log_security_event("command_executed", f"Ejecutado: {command}", user_id=user_id)
+        except asyncio.TimeoutError:
+            await live.update(format_command_output(command, output), force=True)
+            await bot.send_message(chat_id=chat_id, text=f"⏱️ Timeout ({COMMAND_TIMEOUT}s)")
+
+        if output.overflowed:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=output.file(),
+                filename='salida.txt',
+                caption=f"📎 Salida completa ({output.size} bytes)"
+            )
+    finally:
+        output.close()
+
 @authorized_only
 async def schedule_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Programar tarea"""
@@ -472,16 +2624,19 @@ async def schedule_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Formato inválido. Usa HH:MM")
         return
 
+    if not is_command_allowed(command):
+        await update.message.reply_text(f"⛔ Comando no permitido: {command}")
+        log_security_event("blocked_command", f"Intento de programar: {command}", user_id=user_id)
+        return
+
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
+        cursor = await db.execute(
             "INSERT INTO scheduled_tasks (user_id, command, schedule_time, frequency) VALUES (?, ?, ?, ?)",
             (user_id, command, schedule_time, 'daily')
         )
-        task_id = c.lastrowid
-        conn.commit()
-        conn.close()
+        task_id = cursor.lastrowid
+
+        scheduler.add(task_id, user_id, command, schedule_time)
 
         await update.message.reply_text(
             f"✅ Tarea programada\n\n"
@@ -490,7 +2645,9 @@ async def schedule_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📝 {command}"
         )
 
-        log_security_event("task_scheduled", f"Tarea {task_id}: {command} a las {schedule_time}")
+        log_security_event(
+            "task_scheduled", f"Tarea {task_id}: {command} a las {schedule_time}", user_id=user_id
+        )
 
     except Exception as e:
         logger.error(f"Error programando tarea: {e}")
@@ -500,11 +2657,9 @@ async def schedule_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def list_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Listar tareas programadas"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT id, command, schedule_time, active FROM scheduled_tasks WHERE active = 1")
-        tasks = c.fetchall()
-        conn.close()
+        tasks = await db.fetchall(
+            "SELECT id, command, schedule_time, active FROM scheduled_tasks WHERE active = 1"
+        )
 
         if not tasks:
             await update.message.reply_text("📋 No hay tareas programadas")
@@ -530,14 +2685,12 @@ async def cancel_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         task_id = int(context.args[0])
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("UPDATE scheduled_tasks SET active = 0 WHERE id = ?", (task_id,))
-        conn.commit()
-        conn.close()
+        await db.execute("UPDATE scheduled_tasks SET active = 0 WHERE id = ?", (task_id,))
+
+        scheduler.cancel(task_id)
 
         await update.message.reply_text(f"✅ Tarea {task_id} cancelada")
-        log_security_event("task_cancelled", f"Tarea {task_id} cancelada")
+        log_security_event("task_cancelled", f"Tarea {task_id} cancelada", user_id=update.effective_user.id)
 
     except ValueError:
         await update.message.reply_text("❌ ID inválido")
@@ -571,7 +2724,7 @@ async def gpio_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
             led.off()
             await update.message.reply_text(f"✅ GPIO {pin} desactivado")
 
-        log_security_event("gpio_control", f"GPIO {pin} {action}")
+        log_security_event("gpio_control", f"GPIO {pin} {action}", user_id=update.effective_user.id)
 
     except Exception as e:
         logger.error(f"Error controlando GPIO: {e}")
@@ -634,10 +2787,94 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await list_tasks(fake_update, context)
     elif query.data == 'reboot_confirm':
         await query.edit_message_text("🔄 Reiniciando sistema...")
-        log_security_event("system_reboot", "Sistema reiniciado por usuario")
+        log_security_event("system_reboot", "Sistema reiniciado por usuario", user_id=query.from_user.id)
         subprocess.Popen(['sudo', 'reboot'])
     elif query.data == 'reboot_cancel':
         await query.edit_message_text("❌ Reinicio cancelado")
+    elif query.data.startswith('ev|'):
+        await events_page_button(query, context)
+
+# ===== RECONOCIMIENTO DE VOZ =====
+
+vosk_model = None
+vosk_model_lock = threading.Lock()
+# Un único hilo para cargar el modelo y reconocer audio sin bloquear el event loop
+voice_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='voice')
+
+def get_vosk_model():
+    """Cargar el modelo de Vosk una sola vez y compartirlo entre mensajes"""
+    global vosk_model
+    if vosk_model is None:
+        with vosk_model_lock:
+            if vosk_model is None:
+                import vosk
+
+                start = time.monotonic()
+                vosk_model = vosk.Model(VOSK_MODEL_PATH)
+                logger.info(f"Modelo de voz cargado en {time.monotonic() - start:.1f}s")
+    return vosk_model
+
+def transcribe_audio(audio: bytes) -> str:
+    """Reconocer el texto de un audio en memoria (bloqueante).
+
+    ffmpeg decodifica y remuestrea a 16 kHz mono por tuberías (stdin→stdout)
+    y el PCM se pasa por bloques al reconocedor, sin archivos intermedios.
+    """
+    import vosk
+
+    model = get_vosk_model()
+    rec = vosk.KaldiRecognizer(model, VOICE_SAMPLE_RATE)
+
+    proc = subprocess.Popen(
+        ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+         '-ar', str(VOICE_SAMPLE_RATE), '-ac', '1', '-f', 's16le', 'pipe:1'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    # Escribir la entrada en otro hilo para ir leyendo la salida a la vez
+    def feed():
+        try:
+            proc.stdin.write(audio)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+
+    text = ""
+    try:
+        while True:
+            data = proc.stdout.read(VOICE_CHUNK_BYTES)
+            if not data:
+                break
+            if rec.AcceptWaveform(data):
+                result = json.loads(rec.Result())
+                text += result.get("text", "")
+    finally:
+        writer.join()
+        errors = proc.stderr.read()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg falló: {errors.decode(errors='replace').strip()}")
+
+    result = json.loads(rec.FinalResult())
+    text += result.get("text", "")
+    return text
+
+def preload_vosk_model():
+    """Cargar el modelo en segundo plano al arrancar"""
+    def load():
+        try:
+            get_vosk_model()
+        except Exception as e:
+            logger.error(f"No se pudo precargar el modelo de voz: {e}")
+
+    voice_executor.submit(load)
 
 # Handler de voz
 @authorized_only
@@ -646,39 +2883,15 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🎤 Procesando audio...")
 
     try:
-        # Descargar audio
+        # Descargar audio a memoria
         voice_file = await update.message.voice.get_file()
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        audio_path = f"media/voice_{timestamp}.ogg"
-        wav_path = f"media/voice_{timestamp}.wav"
-        
-        await voice_file.download_to_drive(audio_path)
-
-        # Convertir a WAV
-        subprocess.run([
-            'ffmpeg', '-i', audio_path, '-ar', '16000', '-ac', '1', wav_path
-        ], check=True, capture_output=True)
+        audio = bytes(await voice_file.download_as_bytearray())
 
-        # Reconocimiento de voz con vosk
+        # Decodificar y reconocer con vosk (en el hilo de voz)
         try:
-            import vosk
-            import wave
-
-            model = vosk.Model("model")
-            wf = wave.open(wav_path, "rb")
-            rec = vosk.KaldiRecognizer(model, wf.getframerate())
-
-            text = ""
-            while True:
-                data = wf.readframes(4000)
-                if len(data) == 0:
-                    break
-                if rec.AcceptWaveform(data):
-                    result = json.loads(rec.Result())
-                    text += result.get("text", "")
-
-            result = json.loads(rec.FinalResult())
-            text += result.get("text", "")
+            text = await asyncio.get_running_loop().run_in_executor(
+                voice_executor, transcribe_audio, audio
+            )
 
             if not text:
                 await update.message.reply_text("❌ No se pudo reconocer el audio")
@@ -687,7 +2900,7 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"🎤 Reconocido: <i>{text}</i>", parse_mode='HTML')
 
             # Ejecutar comando si está en whitelist
-            if any(text.startswith(allowed) for allowed in COMMANDS_WHITELIST):
+            if is_command_allowed(text):
                 context.args = text.split()
                 await run_command(update, context)
             else:
@@ -700,16 +2913,43 @@ async def voice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error procesando voz: {e}")
         await update.message.reply_text(f"❌ Error procesando audio: {str(e)}")
 
+async def post_init(app: Application):
+    """Guardar el event loop del bot y arrancar los servicios en segundo plano"""
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    await scheduler.start()
+    if VOSK_PRELOAD:
+        preload_vosk_model()
+    app.bot_data['retention_task'] = bot_loop.create_task(retention_loop())
+
+async def post_stop(app: Application):
+    """Detener la detección de movimiento mientras el bot aún puede enviar los avisos pendientes"""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(
+        loop.run_in_executor(None, pipeline.stop)
+        for pipeline in motion_pipelines.values() if pipeline.running
+    ))
+
+async def post_shutdown(app: Application):
+    """Detener los servicios en segundo plano"""
+    await scheduler.stop()
+    retention_task = app.bot_data.pop('retention_task', None)
+    if retention_task:
+        retention_task.cancel()
+
 def main():
     """Función principal"""
+    global application
+
     # Inicializar
-    init_db()
     Path('logs').mkdir(exist_ok=True)
     Path('media').mkdir(exist_ok=True)
-    Path('db').mkdir(exist_ok=True)
+    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    init_db()
+    event_writer.start()
 
-    # Crear aplicación
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Crear aplicación (se reutiliza para las alertas de movimiento)
+    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
 
     # Registrar handlers
     application.add_handler(CommandHandler("start", start))
@@ -717,19 +2957,29 @@ def main():
     application.add_handler(CommandHandler("photo", photo))
     application.add_handler(CommandHandler("motion", toggle_motion))
     application.add_handler(CommandHandler("events", security_events))
-    application.add_handler(CommandHandler("run", run_command))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("search", search_events))
+    # block=False: varios /run avanzan en paralelo sin frenar el resto de updates
+    application.add_handler(CommandHandler("run", run_command, block=False))
     application.add_handler(CommandHandler("schedule", schedule_task))
     application.add_handler(CommandHandler("tasks", list_tasks))
     application.add_handler(CommandHandler("cancel", cancel_task))
     application.add_handler(CommandHandler("gpio", gpio_control))
     application.add_handler(CommandHandler("reboot", reboot_system))
     application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.VOICE, voice_handler))
+    # block=False: la transcripción y el comando no frenan el resto de updates
+    application.add_handler(MessageHandler(filters.VOICE, voice_handler, block=False))
 
     logger.info("🤖 Sistema de seguridad iniciado")
     log_security_event("system_started", "Bot iniciado correctamente")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        for camera in cameras.values():
+            camera.stop()
+        event_writer.stop()
+        db.close()
 
 if __name__ == '__main__':
     main()